@@ -0,0 +1,152 @@
+import json
+import subprocess
+import tempfile
+import time
+import pandas as pd
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+from get_tables import test_map, TestResultRegistry, keep_latest_per_sn
+from discovery import RunDiscovery
+from cuts import get_default_cut_table
+from store import ResultStore
+from synthetic import make_campaign
+
+
+class Timer:
+    """
+    Accumulates the wall time of named stages
+    """
+    def __init__(self) -> None:
+        self.timings = {}
+
+
+    @contextmanager
+    def stage(self,
+              name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(base_dir: str | Path,
+                  tests: list[str],
+                  output_dir: str | Path) -> dict:
+    """
+    Times the stages of get_tables.py on the run directories of base_dir:
+    discovery, scanning the directories, parsing per Test class, merging,
+    cut evaluation and writing the output. The parsing includes the cuts
+    applied by get_data, the cuts stage evaluates them again on their own.
+    """
+    timer = Timer()
+    with timer.stage("discovery"):
+        test_result_dirs = RunDiscovery(base_dir).discover()
+
+    registry = TestResultRegistry()
+    with timer.stage("scan"):
+        trs = []
+        for d in test_result_dirs:
+            try:
+                trs.append(registry.get(d))
+            except FileNotFoundError:
+                continue
+
+    frames = {}
+    for test in tests:
+        frames[test] = []
+        with timer.stage(f"parse/{test_map[test].__name__}"):
+            for tr in trs:
+                if not tr.has_data(test):
+                    continue
+                data = tr.get_data(test)
+                if data is not None:
+                    frames[test].append(data)
+
+    cut_table = get_default_cut_table()
+    with timer.stage("cuts"):
+        for test in tests:
+            name = test_map[test](check_exists=False).name
+            for data in frames[test]:
+                cut_table.apply(name, data)
+
+    merged = {}
+    with timer.stage("merge"):
+        for test in tests:
+            merged[test] = keep_latest_per_sn(frames[test]).set_index("SN")
+
+    store = ResultStore(Path(output_dir) / "dataset")
+    with timer.stage("write"):
+        locations = {test: store.write_test(test, df) for test, df in merged.items()}
+        store.write_board_index(locations)
+
+    return {"dirs": len(test_result_dirs),
+            "rows": int(sum(len(df) for df in merged.values())),
+            "timings": timer.timings}
+
+
+def record(result: dict,
+           results_file: str | Path) -> None:
+    # one JSON line per run, so that runs of different commits can be compared
+    Path(results_file).parent.mkdir(parents=True, exist_ok=True)
+    with open(results_file, "a") as file:
+        file.write(json.dumps(result) + "\n")
+
+
+def compare(results_file: str | Path,
+            last: int = 5) -> pd.DataFrame:
+    # stage timings (s) of the last runs, one column per run
+    with open(results_file, "r") as file:
+        runs = [json.loads(line) for line in file if line.strip() != ""][-last:]
+    columns = {f"{run['time']} {run['commit']}": pd.Series(run["timings"]) for run in runs}
+    return pd.DataFrame(columns)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the stages of get_tables.py")
+    parser.add_argument("--base_dir",
+                        type=str,
+                        default=None,
+                        help="Run directories to benchmark with (default: a synthetic campaign)")
+    parser.add_argument("--n_dirs",
+                        type=int,
+                        default=20,
+                        help="Number of run directories of the synthetic campaign")
+    parser.add_argument("--testers",
+                        type=int,
+                        default=8,
+                        help="Number of boards per run directory of the synthetic campaign")
+    parser.add_argument("--tests",
+                        type=str,
+                        nargs="+",
+                        default=list(test_map.keys()),
+                        help="Tests to benchmark")
+    parser.add_argument("--results",
+                        type=str,
+                        default="output/benchmark_results.jsonl",
+                        help="File the results are appended to")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        base_dir = args.base_dir
+        scale = {"base_dir": base_dir}
+        if base_dir is None:
+            base_dir = Path(workdir) / "campaign"
+            make_campaign(base_dir, n_dirs=args.n_dirs, testers=args.testers,
+                          sn_pool=args.n_dirs * args.testers // 2)
+            scale = {"n_dirs": args.n_dirs, "testers": args.testers}
+        result = run_benchmark(base_dir, args.tests, Path(workdir) / "output")
+    result = {"time": datetime.now().strftime("%Y-%m-%d %H:%M"), "commit": git_commit(), **scale, **result}
+    record(result, args.results)
+    print(compare(args.results).to_string(float_format="{:.3f}".format))
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import shutil
+import threading
+import pandas as pd
+from collections import OrderedDict
+from pathlib import Path
+
+from store import write_atomically
+
+
+class ResultCache:
+    """
+    Cache of the parsed frames of every (run directory, test) pair.
+
+    Each frame is stored as one Parquet file per directory and test, the
+    manifest (manifest.json in cache_dir) records the signature of the input
+    it was parsed from (mtime and size of the test file and the tester to
+    serial mapping of the directory). A frame is only reused if the
+    signature still matches, so new or changed directories are parsed again
+    and everything else is read back from the cache.
+    """
+
+    def __init__(self,
+                 cache_dir: str | Path = "output/cache") -> None:
+        self.cache_dir = Path(cache_dir)
+        self.manifest_file = self.cache_dir / "manifest.json"
+        if self.manifest_file.exists():
+            with open(self.manifest_file, "r") as file:
+                self.manifest = json.load(file)
+        else:
+            self.manifest = {}
+        # the cache is shared between the threads of a threaded merge
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.pruned = 0
+
+
+    def _key(self,
+             path: str | Path,
+             test: str,
+             method: str) -> str:
+        return f"{path}|{test}|{method}"
+
+
+    def _filename(self,
+                  path: str | Path,
+                  test: str,
+                  method: str) -> str:
+        # run directories of different base directories can share their name, the hash of the full path tells them apart
+        digest = hashlib.sha1(str(path).encode()).hexdigest()[:12]
+        return f"{Path(path).name}-{digest}/{test}.{method}.parquet"
+
+
+    def load(self,
+             path: str | Path,
+             test: str,
+             method: str,
+             signature: dict) -> tuple[bool, pd.DataFrame | None]:
+        """
+        Returns (True, frame) if the cached frame is still valid, (False, None) otherwise.
+        The frame is None if the directory couldn't be parsed for the test.
+        """
+        with self._lock:
+            entry = self.manifest.get(self._key(path, test, method))
+        # entries written before the files were named after the full path are parsed again
+        if (entry is None or entry["signature"] != signature
+                or entry["file"] not in (None, self._filename(path, test, method))):
+            with self._lock:
+                self.misses += 1
+            return False, None
+        if entry["file"] is None:
+            data = None
+        else:
+            data = pd.read_parquet(self.cache_dir / entry["file"])
+        with self._lock:
+            self.hits += 1
+        return True, data
+
+
+    def store(self,
+              path: str | Path,
+              test: str,
+              method: str,
+              signature: dict,
+              data: pd.DataFrame | None) -> None:
+        filename = None
+        if data is not None:
+            filename = self._filename(path, test, method)
+            (self.cache_dir / filename).parent.mkdir(parents=True, exist_ok=True)
+            data.to_parquet(self.cache_dir / filename, index=False)
+        with self._lock:
+            self.manifest[self._key(path, test, method)] = {"signature": signature,
+                                                            "file": filename}
+
+
+    def prune(self,
+              base_dir: str | Path,
+              test_result_dirs: list[Path]) -> None:
+        """
+        Drops the entries and frames of the run directories of base_dir that
+        are not in test_result_dirs (removed or no longer good) and of the
+        directories that no longer exist. Entries of the other base
+        directories sharing the cache are kept.
+        """
+        base_dir = Path(base_dir)
+        keep = {str(d) for d in test_result_dirs}
+        with self._lock:
+            paths = {key.rsplit("|", 2)[0] for key in self.manifest}
+            gone = {path for path in paths if path not in keep
+                    and (Path(path).parent == base_dir or not Path(path).exists())}
+            for key in [key for key in self.manifest if key.rsplit("|", 2)[0] in gone]:
+                entry = self.manifest.pop(key)
+                if entry["file"] is not None:
+                    (self.cache_dir / entry["file"]).unlink(missing_ok=True)
+        for path in gone:
+            # the directory holding the frames of the run directory, empty by now
+            shutil.rmtree(self.cache_dir / Path(self._filename(path, "", "")).parent, ignore_errors=True)
+        self.pruned = len(gone)
+
+
+    def save(self) -> None:
+        def write(tmp_file):
+            with open(tmp_file, "w") as file:
+                json.dump(self.manifest, file)
+        with self._lock:
+            write_atomically(self.manifest_file, write)
+
+
+    def report(self) -> None:
+        print(f"Result cache: reused {self.hits} parsed frames, parsed {self.misses} new or changed ones, "
+              f"dropped {self.pruned} run directories that are gone")
+
+
+class ParseCache:
+    """
+    In-memory cache of parsed frames, e.g. of the tests of a run directory,
+    holding at most max_bytes (memory_usage(deep=True) of the frames). When
+    it is full the least recently used frames are evicted. Frames are handed
+    out as shallow copies, so that adding or dropping columns doesn't change
+    the cached frame.
+    """
+
+    def __init__(self,
+                 max_bytes: int = 512 * 2**20) -> None:
+        self.max_bytes = max_bytes
+        # key -> (frame or None, size in bytes), the most recently used last
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self,
+            key: tuple) -> tuple[bool, pd.DataFrame | None]:
+        # (True, frame) if the key is cached, (False, None) otherwise
+        with self._lock:
+            entry = self._frames.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._frames.move_to_end(key)
+            self.hits += 1
+        data = entry[0]
+        return True, data.copy(deep=False) if data is not None else None
+
+
+    def put(self,
+            key: tuple,
+            data: pd.DataFrame | None) -> None:
+        size = int(data.memory_usage(deep=True).sum()) if data is not None else 0
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._frames:
+                self.nbytes -= self._frames.pop(key)[1]
+            self._frames[key] = (data.copy(deep=False) if data is not None else None, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self._frames.popitem(last=False)
+                self.nbytes -= evicted
+
+
+    def clear(self) -> None:
+        with self._lock:
+            self._frames.clear()
+            self.nbytes = 0
+
+
+    def __reduce__(self):
+        # sent to the workers of a process pool without the frames and the lock,
+        # the default cache stays the one default cache of the worker
+        if self is _default_parse_cache:
+            return get_default_parse_cache, ()
+        return ParseCache, (self.max_bytes,)
+
+
+_default_parse_cache = None
+
+
+def get_default_parse_cache() -> ParseCache:
+    # one cache per process for all TestResults built without one, the byte limit holds for all of them
+    global _default_parse_cache
+    if _default_parse_cache is None:
+        _default_parse_cache = ParseCache()
+    return _default_parse_cache
@@ -0,0 +1,184 @@
+import hashlib
+import re
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+default_cuts_file = Path(__file__).parent / "cuts.csv"
+
+
+class CutTable:
+    """
+    Pass/fail criteria of all tests, read from a table (cuts.csv by default)
+    with one row per cut:
+
+    test:      name of the Test the cut belongs to (Test.name)
+    cut:       name of the cut, the failures are flagged in fail_<cut>
+    variable:  column (or expression of columns) the bounds are applied to
+    min, max:  exclusive bounds, empty for no bound. Simple arithmetic is allowed
+    selection: optional expression, the cut only applies to the rows it selects
+
+    Changing a limit only needs a change of the table, not of the code.
+    """
+
+    def __init__(self,
+                 table: pd.DataFrame) -> None:
+        self.table = table.fillna({"selection": ""})
+        self.table["min"] = [self._bound(b, -np.inf) for b in self.table["min"]]
+        self.table["max"] = [self._bound(b, np.inf) for b in self.table["max"]]
+        self._by_test = {test: cuts.reset_index(drop=True) for test, cuts in self.table.groupby("test")}
+        self._compiled_by_test = {}
+
+
+    def __getstate__(self) -> dict:
+        # the compiled expressions can't be pickled (process pool), they are compiled again
+        return {**self.__dict__, "_compiled_by_test": {}}
+
+
+    @classmethod
+    def from_csv(cls,
+                 path: str | Path = default_cuts_file) -> "CutTable":
+        table = pd.read_csv(path, comment="#", dtype=str, skipinitialspace=True)
+        return cls(table)
+
+
+    @staticmethod
+    def _bound(bound, default: float) -> float:
+        if pd.isna(bound) or str(bound).strip() == "":
+            return default
+        try:
+            return float(bound)
+        except ValueError:
+            # bounds like "(220 + 5.11) / 5.11 * 0.000445"
+            return float(pd.eval(bound, engine="python"))
+
+
+    def fingerprint(self) -> str:
+        # changes whenever a cut changes, used to invalidate cached results
+        return hashlib.md5(self.table.to_csv(index=False).encode()).hexdigest()
+
+
+    def cuts_for(self,
+                 test: str) -> pd.DataFrame:
+        return self._by_test.get(test, self.table.iloc[0:0])
+
+
+    def columns_for(self,
+                    test: str) -> list[str]:
+        # names used in the variables and selections of the cuts of the test,
+        # a superset of the columns needed to evaluate them
+        cuts = self.cuts_for(test)
+        names = re.findall(r"[A-Za-z_]\w*", " ".join([*cuts["variable"], *cuts["selection"]]))
+        return list(dict.fromkeys(names))
+
+
+    def evaluate(self,
+                 test: str,
+                 data: pd.DataFrame) -> pd.DataFrame:
+        """
+        Returns one boolean fail_<cut> column per cut of the test
+        """
+        return pd.DataFrame(self._failures(test, data), index=data.index)
+
+
+    def apply(self,
+              test: str,
+              data: pd.DataFrame) -> pd.DataFrame:
+        """
+        Adds the fail_<cut> columns and test_pass (no cut failed) to data.
+        data is returned unchanged if there are no cuts for the test.
+        """
+        failures = self._failures(test, data)
+        if len(failures) == 0:
+            return data
+        names = [*failures, "test_pass"]
+        # the flags are filled into one boolean block (one row per column, as pandas stores it),
+        # the columns of data are not copied by the concat
+        flags = np.zeros((len(names), len(data)), dtype=bool)
+        for i, failed in enumerate(failures.values()):
+            flags[i] = failed
+            flags[-1] |= failed
+        np.logical_not(flags[-1], out=flags[-1])
+        existing = [col for col in names if col in data.columns]
+        if len(existing) > 0:
+            # evaluated again, e.g. with another cut table
+            data = data.drop(columns=existing)
+        return pd.concat([data, pd.DataFrame(flags.T, index=data.index, columns=names)], axis=1)
+
+
+    def _failures(self,
+                  test: str,
+                  data: pd.DataFrame) -> dict[str, np.ndarray]:
+        # fail_<cut> -> rows failing the cut, every cut is compared on its own column
+        failures = {}
+        columns = _Columns(data)
+        for cut, variable, low, high, selection in self._compiled(test):
+            values = variable(columns)
+            # NaN values fail, every comparison with NaN is False
+            if low == -np.inf and high == np.inf:
+                passed = ~np.isnan(values)
+            elif low == -np.inf:
+                passed = values < high
+            elif high == np.inf:
+                passed = values > low
+            else:
+                passed = (values > low) & (values < high)
+            failed = ~passed
+            if selection is not None:
+                failed &= selection(columns)
+            failures[f"fail_{cut}"] = failed
+        return failures
+
+
+    def _compiled(self,
+                  test: str) -> list[tuple]:
+        # the variables and selections of the cuts of the test compiled once per table
+        compiled = self._compiled_by_test.get(test)
+        if compiled is None:
+            compiled = [(row.cut, self._expression(row.variable), row.min, row.max,
+                         self._expression(row.selection) if row.selection != "" else None)
+                        for row in self.cuts_for(test).itertuples(index=False)]
+            self._compiled_by_test[test] = compiled
+        return compiled
+
+
+    @staticmethod
+    def _expression(expression: str):
+        # a column is looked up directly, anything else is evaluated on the numpy arrays of the columns it uses
+        expression = expression.strip()
+        if re.fullmatch(r"[A-Za-z_]\w*", expression):
+            return lambda columns: columns[expression]
+        code = compile(expression, "<cut>", "eval")
+        return lambda columns: np.asarray(eval(code, {"__builtins__": {}}, columns))
+
+
+class _Columns(dict):
+    """
+    Numpy arrays of the columns of a frame, fetched when an expression first
+    uses them
+    """
+
+    def __init__(self,
+                 data: pd.DataFrame) -> None:
+        super().__init__()
+        self.data = data
+
+
+    def __missing__(self,
+                    name: str) -> np.ndarray:
+        if name not in self.data.columns:
+            raise KeyError(name)
+        values = self.data[name].to_numpy()
+        self[name] = values
+        return values
+
+
+_default_cut_table = None
+
+
+def get_default_cut_table() -> CutTable:
+    # the default table is read once per process
+    global _default_cut_table
+    if _default_cut_table is None:
+        _default_cut_table = CutTable.from_csv(default_cuts_file)
+    return _default_cut_table
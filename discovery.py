@@ -0,0 +1,157 @@
+import json
+import re
+import pandas as pd
+from pathlib import Path
+
+from store import write_atomically
+
+# run directories are named after the timestamp of the run (yyyymmddhhmm), possibly followed by a suffix
+run_dir_regex = re.compile(r"^(\d+)")
+sn_regex = re.compile(r"SN_3211[\s_]0[\s_]03[\s_]0[\s_]00[\s_]([\d]+)\.txt")
+
+
+def read_tester_to_serial(d: Path,
+                          serial_files: list[str]) -> dict[int, int]:
+    # tester ID written in every serial file (relative to d) -> SN in its name
+    tester_to_serial = {}
+    for name in serial_files:
+        sn = int(sn_regex.search(Path(name).name).group(1))
+        with open(d / name, "r") as file:
+            tester_to_serial[int(file.read().strip())] = sn
+    return tester_to_serial
+
+
+class RunDiscovery:
+    """
+    Finds the run directories of base_dir and validates their format: a
+    directory is good if it holds detailed_results.tsv and at least one serial
+    file (SN_3211*.txt).
+
+    The result of the validation is kept in a manifest (manifest_file, if
+    given, is read at the start and written by save) together with the mtime
+    of the directory, of its subdirectories and of its serial files, their
+    tester IDs and the files it contains. Only directories that are new or
+    where one of these mtimes changed are listed again, so discovering a
+    large archive costs one listing of base_dir and a few stats per
+    directory.
+    """
+
+    def __init__(self,
+                 base_dir: str | Path,
+                 manifest_file: str | Path | None = None) -> None:
+        self.base_dir = Path(base_dir)
+        self.manifest_file = Path(manifest_file) if manifest_file is not None else None
+        self.manifest = {}
+        if self.manifest_file is not None and self.manifest_file.exists():
+            with open(self.manifest_file, "r") as file:
+                manifest = json.load(file)
+            # a manifest of another base directory is of no use
+            if manifest.get("base_dir") == str(self.base_dir):
+                self.manifest = manifest["dirs"]
+        self.validated = 0
+
+
+    @staticmethod
+    def timestamp(d: str | Path) -> int:
+        return int(run_dir_regex.match(Path(d).name).group(1))
+
+
+    @staticmethod
+    def run_time(d: str | Path) -> pd.Timestamp:
+        # time of the run, NaT if the name of the directory isn't a yyyymmddhhmm timestamp
+        return pd.to_datetime(run_dir_regex.match(Path(d).name).group(1), format="%Y%m%d%H%M", errors="coerce")
+
+
+    def validate(self,
+                 d: Path) -> dict:
+        self.validated += 1
+        files = sorted(p.name for p in d.iterdir() if p.is_file())
+        serial_files = sorted(str(p.relative_to(d)) for p in d.rglob("SN_3211*.txt")
+                              if sn_regex.search(p.name) is not None)
+        # a serial file added to a subdirectory or rewritten in place leaves the mtime of d unchanged
+        subdirs = {str(p.relative_to(d)): p.stat().st_mtime_ns for p in d.rglob("*") if p.is_dir()}
+        serial_mtime_ns = [(d / name).stat().st_mtime_ns for name in serial_files]
+        try:
+            # kept as [tester, SN] pairs, JSON has no integer keys
+            tester_to_serial = sorted(read_tester_to_serial(d, serial_files).items())
+        except ValueError:
+            # the TestResult of the directory reads the serial files again and reports the error
+            tester_to_serial = None
+        return {"mtime_ns": d.stat().st_mtime_ns,
+                "files": files,
+                "subdir_mtime_ns": subdirs,
+                "serial_files": serial_files,
+                "serial_mtime_ns": serial_mtime_ns,
+                "tester_to_serial": tester_to_serial,
+                "good": "detailed_results.tsv" in files and len(serial_files) >= 1}
+
+
+    @staticmethod
+    def unchanged(d: Path,
+                  entry: dict) -> bool:
+        # the directory, its subdirectories and its serial files still have the mtimes of the entry
+        if "serial_mtime_ns" not in entry:
+            # entries of older manifests have no mtimes of the serial files yet
+            return False
+        try:
+            return (d.stat().st_mtime_ns == entry["mtime_ns"]
+                    and all((d / name).stat().st_mtime_ns == mtime
+                            for name, mtime in entry["subdir_mtime_ns"].items())
+                    and [(d / name).stat().st_mtime_ns for name in entry["serial_files"]] == entry["serial_mtime_ns"])
+        except FileNotFoundError:
+            return False
+
+
+    def entry(self,
+              d: str | Path) -> dict | None:
+        # manifest entry of a run directory of base_dir, None if it wasn't discovered
+        d = Path(d)
+        if d.parent != self.base_dir:
+            return None
+        return self.manifest.get(d.name)
+
+
+    def discover(self) -> list[Path]:
+        """
+        Returns the good run directories sorted by their timestamp
+        """
+        manifest = {}
+        for d in self.base_dir.iterdir():
+            if run_dir_regex.match(d.name) is None or not d.is_dir():
+                continue
+            entry = self.manifest.get(d.name)
+            if entry is None or not self.unchanged(d, entry):
+                entry = self.validate(d)
+            manifest[d.name] = entry
+        # directories that were removed are dropped from the manifest
+        self.manifest = manifest
+
+        names = sorted(manifest, key=lambda name: (self.timestamp(name), name))
+        good = [self.base_dir / name for name in names if manifest[name]["good"]]
+        bad = [str(self.base_dir / name)+"\n" for name in names if not manifest[name]["good"]]
+        print(f"Found {len(good)} directories with the correct format")
+        print(f"bad format dirs: {bad}")
+        return good
+
+
+    def save(self) -> None:
+        if self.manifest_file is None:
+            return
+        def write(tmp_file):
+            with open(tmp_file, "w") as file:
+                json.dump({"base_dir": str(self.base_dir), "dirs": self.manifest}, file)
+        write_atomically(self.manifest_file, write)
+
+
+    def report(self) -> None:
+        print(f"Run discovery: validated {self.validated} new or changed directories, "
+              f"reused {len(self.manifest) - self.validated} from the manifest")
+
+
+def get_test_result_dirs(base_dir: str | Path,
+                         manifest_file: str | Path | None = None) -> list[Path]:
+    # good run directories of base_dir, the manifest is updated if given
+    discovery = RunDiscovery(base_dir, manifest_file)
+    test_result_dirs = discovery.discover()
+    discovery.save()
+    return test_result_dirs
@@ -1,11 +1,23 @@
 import pandas as pd
-import re
+import numpy as np
 import os
 import pickle
+import shutil
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 from tqdm import tqdm
 from pathlib import Path 
 
 from tests import *
+from cache import ResultCache, ParseCache, get_default_parse_cache
+from store import ResultStore
+from discovery import RunDiscovery, read_tester_to_serial, sn_regex
+from yield_engine import YieldMatrix
+from trends import YieldTrends
+from history import RetestHistory, yield_policies
+from cuts import CutTable, get_default_cut_table
+import profiling
 
 test_map = {"Aldo": Aldo,
             "TestPulse": TestPulse,
@@ -28,6 +40,10 @@ test_map = {"Aldo": Aldo,
             "Pt_1000": Pt_1000}
 
 
+# per-channel tests, their merged frames are the largest ones (see Plotter.stream_merge_for_test)
+streaming_tests = ["TDCCalibration", *[f"QDCCalibration{i}" for i in range(8)], "TestPulse", "ExtTestPulse"]
+
+
 class TestResult:
 
     def __init__(self,
@@ -51,121 +67,419 @@ class TestResult:
                                     "Tec",
                                     "Pt_1000",
                                     "CaInit"],
+                engine: str = "c",
+                cut_table: CutTable | None = None,
+                parse_cache: ParseCache | None = None,
+                inventory: dict | None = None,
                 ) -> None:
-      
+        """
+        Scans the run directory at path: lists its files once and reads the
+        serial files. With an inventory (the RunDiscovery manifest entry of an
+        unchanged directory) the files and the tester IDs are taken from it
+        and the directory isn't touched at all.
+        The test files are only parsed when their data is
+        requested, a missing test file only fails the tests that need it.
+        The parsed frames are kept in parse_cache (by default the one shared
+        by all TestResults of the process, see cache.get_default_parse_cache),
+        so asking for the same data again doesn't read the file again.
+        """
         self.path = path
         self.tests = tests
-
-        # for each test assert that the corresponding file exists
-        for test in self.tests:
-            datafile = test_map[test](test_result_dir=self.path).datafile
-            if not datafile.exists(): 
-                raise FileNotFoundError(f"File {datafile} not found in {self.path}")
-
-        self.sn_regex = re.compile(r"SN_3211[\s_]0[\s_]03[\s_]0[\s_]00[\s_]([\d]+)\.txt")
-        self.serial_files = [f for f in Path(self.path).rglob('SN_3211*.txt')]
-        # make sure that the last split has numbers in front of the stem
-        self.serial_files = [f for f in self.serial_files if self.sn_regex.match(f.name)]
+        # pandas read_csv engine used by the tests ("c" or "pyarrow")
+        self.engine = engine
+        self.cut_table = cut_table if cut_table is not None else get_default_cut_table()
+        self.parse_cache = parse_cache if parse_cache is not None else get_default_parse_cache()
+        # number of filesystem calls (listdir, rglob, open) it took to scan the directory
+        self.fs_calls = 0
+
+        if inventory is not None and inventory.get("tester_to_serial") is not None:
+            self.files = set(inventory["files"])
+            self.serial_files = [Path(self.path) / f for f in inventory["serial_files"]]
+            self.tester_to_serial = {tester: sn for tester, sn in inventory["tester_to_serial"]}
+        else:
+            # list the directory once and check every test file against that inventory
+            self.files = {f.name for f in Path(self.path).iterdir()}
+            self.fs_calls += 1
+            self.serial_files = [f for f in Path(self.path).rglob('SN_3211*.txt') if sn_regex.search(f.name)]
+            self.fs_calls += 1
+            self.tester_to_serial = read_tester_to_serial(Path(self.path),
+                                                          [f.relative_to(self.path) for f in self.serial_files])
+            self.fs_calls += len(self.serial_files)
         assert len(self.serial_files) > 0, "No serial files found in the directory"
+        self.missing = [test for test in self.tests if self.get_datafile(test).name not in self.files]
+        # shared by all tests of the directory to map the tester IDs to serials
+        self.sn_lookup = SerialLookup(self.tester_to_serial)
 
-        self.tester_to_serial = {}
-        for f in self.serial_files: 
-            if " " in f.stem:
-                sn = int(f.stem.split(" ")[-1])
-            else:
-                sn = int(f.stem.split("_")[-1])
-            with open(f, "r") as file:
-                tester = int(file.read().strip())
-            self.tester_to_serial[tester] = sn
+
+    def get_datafile(self,
+                     test: str) -> Path:
+        return test_map[test](test_result_dir=self.path, check_exists=False).datafile
+
+
+    def has_data(self,
+                 test: str) -> bool:
+        # the test file is in the directory
+        return test in self.tests and test not in self.missing
+
+
+    def _check_test(self,
+                    test: str) -> None:
+        if test not in self.tests:
+            raise ValueError(f"Test {test} not in {self.tests}")
+        if test in self.missing:
+            raise FileNotFoundError(f"File {self.get_datafile(test)} not found in {self.path}")
+
+
+    def _test_args(self,
+                   test: str) -> dict:
+        return {"label": test,
+                "test_result_dir": self.path,
+                "tester_to_serial": self.tester_to_serial,
+                "sn_lookup": self.sn_lookup,
+                "cut_table": self.cut_table,
+                "engine": self.engine}
 
 
     def get_data(self,
                 test: str,
                 filename: str = ""
                 ) -> pd.DataFrame:
-        if test not in self.tests:
+        if filename == "":
+            self._check_test(test)
+        elif test not in self.tests:
             raise ValueError(f"Test {test} not in {self.tests}")
-        
-        test_args = {"test_result_dir": self.path,
-                    "tester_to_serial": self.tester_to_serial}
+        test_args = self._test_args(test)
         if filename != "":
             test_args["filename"] = filename
-            try:
-                data = test_map[test](**test_args).get_data()
-                return data
-            except ValueError as e:
-                if str(e) == "Some Tester ID's present in data couldn't be assigned a serial file":
-                    return None
-        else:
-            try:
-                data = test_map[test](**test_args).get_data()
-                return data
-            except ValueError as e:
-                if str(e) == "Some Tester ID's present in data couldn't be assigned a serial file":
-                    return None
-
-        
+        test_obj = test_map[test](**test_args, check_exists=False)
+        # a rewritten file has another mtime and is parsed again
+        key = (str(self.path), test, "get_data", filename, test_obj.datafile.stat().st_mtime_ns)
+        hit, data = self.parse_cache.get(key)
+        if hit:
+            return data
+
+        try:
+            data = test_obj.get_data()
+        except ValueError:
+            # e.g. "Some Tester ID's present in data couldn't be assigned a serial file"
+            data = None
+        self.parse_cache.put(key, data)
+        return data
+
+
     def get_passing_info(self,
-                        test: str
+                        test: str,
+                        pass_only: bool = False
                         ) -> pd.DataFrame:
-        if test not in self.tests:
-            raise ValueError(f"Test {test} not in {self.tests}")
+        self._check_test(test)
+        test_obj = test_map[test](**self._test_args(test), check_exists=False)
+        if not test_obj.reads_pass_data(pass_only):
+            # from the memoized frame of get_data, the file isn't parsed again
+            data = self.get_data(test)
+            return Test.passing_frame(data) if data is not None else None
+        key = (str(self.path), test, "get_passing_info", pass_only, test_obj.datafile.stat().st_mtime_ns)
+        hit, data = self.parse_cache.get(key)
+        if hit:
+            return data
 
-        test_args = {"test_result_dir": self.path,
-                    "tester_to_serial": self.tester_to_serial}
         try:
-            data = test_map[test](**test_args).get_passing_info()
-            return data
+            data = test_obj.get_passing_info(pass_only)
         except ValueError as e:
             print(e)
+            data = None
+        self.parse_cache.put(key, data)
+        return data
+
+
+    def get_pass_only_info(self,
+                           test: str
+                           ) -> pd.DataFrame:
+        # only reads the columns the cuts need, see Test.get_passing_info
+        return self.get_passing_info(test, pass_only=True)
             
 
 
+class TestResultRegistry:
+    """
+    Scans every run directory once and shares the resulting TestResult
+    (file inventory and tester_to_serial map) between all tests.
+    Directories that can't be scanned are remembered as well, so they
+    are not rescanned for every test either. The TestResults share one
+    ParseCache of parse_cache_bytes, 0 disables the memoization (every
+    file is parsed once per run anyway when the tables are built).
+    With a discovery, directories that are unchanged since they were last
+    validated are not scanned, their inventory is taken from its manifest
+    (the listing, rglob and serial file reads it avoids count as saved).
+    """
+
+    def __init__(self,
+                 engine: str = "c",
+                 cut_table: CutTable | None = None,
+                 parse_cache_bytes: int = 0,
+                 discovery: RunDiscovery | None = None) -> None:
+        self.engine = engine
+        self.cut_table = cut_table
+        self.parse_cache = ParseCache(parse_cache_bytes)
+        self.discovery = discovery
+        # str(path) -> (TestResult or the FileNotFoundError of the scan, fs calls a scan takes)
+        self._results = {}
+        # the registry is shared between the threads of a threaded merge
+        self._lock = threading.Lock()
+        self.scans = 0
+        self.from_manifest = 0
+        self.hits = 0
+        self.saved_fs_calls = 0
+
+
+    def get(self,
+            path: str | Path) -> TestResult:
+        key = str(path)
+        with self._lock:
+            cached = self._results.get(key)
+            if cached is not None:
+                self.hits += 1
+                self.saved_fs_calls += cached[1]
+        if cached is None:
+            # scan outside of the lock, so that threads scan different directories in parallel
+            with profiling.stage("scan", directory=path) as record:
+                inventory = self.discovery.entry(path) if self.discovery is not None else None
+                try:
+                    tr = TestResult(path=path, engine=self.engine, cut_table=self.cut_table,
+                                    parse_cache=self.parse_cache, inventory=inventory)
+                    # taken from the manifest, the listing, the rglob and the serial files were not read
+                    scanned = (tr, tr.fs_calls if tr.fs_calls > 0 else len(tr.serial_files) + 2)
+                except FileNotFoundError as e:
+                    # the directory listing was the only call made
+                    scanned = (e, 1)
+                record["files"] = scanned[1]
+            with self._lock:
+                if isinstance(scanned[0], TestResult) and scanned[0].fs_calls == 0:
+                    self.from_manifest += 1
+                    self.saved_fs_calls += scanned[1]
+                else:
+                    self.scans += 1
+                cached = self._results.setdefault(key, scanned)
+        result = cached[0]
+        if isinstance(result, FileNotFoundError):
+            raise result
+        return result
+
+
+    def report(self):
+        print(f"Scanned {self.scans} run directories, took {self.from_manifest} from the discovery manifest, "
+              f"reused them {self.hits} times "
+              f"and saved {self.saved_fs_calls} filesystem calls")
+
+
+def _get_test_data(tr: TestResult | None,
+                   test: str,
+                   method: str) -> pd.DataFrame | None:
+    # module level, so that it can be sent to the workers of a process pool
+    if tr is None:
+        return None
+    # the test file is only looked up if the parsing is profiled
+    datafile = tr.get_datafile(test) if profiling.active is not None else None
+    with profiling.stage("parse", test=test, directory=tr.path, path=datafile) as record:
+        data = getattr(tr, method)(test)
+        record["rows"] = len(data) if data is not None else 0
+    return data
+
+
+def _cache_signature(tr: TestResult,
+                     test: str) -> dict:
+    # a cached frame is valid as long as the test file, the serial mapping and the cuts are unchanged
+    stat = tr.get_datafile(test).stat()
+    return {"mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "tester_to_serial": [[tester, sn] for tester, sn in sorted(tr.tester_to_serial.items())],
+            "cuts": tr.cut_table.fingerprint()}
+
+
+def _windowed(items,
+              start,
+              window: int):
+    """
+    Yields (item, start(item)) in the order of items, starting at most window
+    items ahead of the one yielded. With start submitting to a pool, only
+    about window results are held at a time, however fast the later items
+    finish compared to a slow early one.
+    """
+    pending = deque()
+    for item in items:
+        pending.append((item, start(item)))
+        if len(pending) >= window:
+            yield pending.popleft()
+    while len(pending) > 0:
+        yield pending.popleft()
+
+
+def read_test_result_dirs(test_result_dirs: list[Path],
+                          test: str,
+                          method: str,
+                          registry: TestResultRegistry,
+                          workers: int = 1,
+                          executor: str = "thread",
+                          cache: ResultCache | None = None):
+    """
+    Yields (directory, TestResult, data) for every run directory, where data is the
+    output of TestResult.<method>(test). TestResult is None if the file of the test is missing.
+    With workers > 1 the directories are parsed in a thread or process pool, the
+    results are still yielded in the order of test_result_dirs. Only workers + 1
+    directories are submitted ahead of the one yielded.
+    With a cache only new or changed directories are parsed, saving the cache
+    is left to the caller (ResultCache.save).
+    """
+    def scan(d):
+        try:
+            tr = registry.get(d)
+        except FileNotFoundError:
+            return None
+        # directories missing the file of this test are still used for the other tests
+        return tr if tr.has_data(test) else None
+
+    def read(tr):
+        if tr is None or cache is None:
+            return _get_test_data(tr, test, method)
+        signature = _cache_signature(tr, test)
+        with profiling.stage("cache_load", test=test, directory=tr.path) as record:
+            hit, data = cache.load(str(tr.path), test, method, signature)
+            record["rows"] = len(data) if hit and data is not None else 0
+        if not hit:
+            data = _get_test_data(tr, test, method)
+            cache.store(str(tr.path), test, method, signature, data)
+        return data
+
+    if workers <= 1:
+        for d in test_result_dirs:
+            tr = scan(d)
+            yield d, tr, read(tr)
+    elif executor == "process":
+        # scan and look up the cache in this process, only the parsing runs in the workers
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            def start(d):
+                tr = scan(d)
+                if tr is None:
+                    # nothing to parse, the directory is skipped for this test
+                    return tr, None, None
+                if cache is None:
+                    return tr, None, pool.submit(_get_test_data, tr, test, method)
+                signature = _cache_signature(tr, test)
+                hit, data = cache.load(str(tr.path), test, method, signature)
+                return tr, signature, data if hit else pool.submit(_get_test_data, tr, test, method)
+            for d, (tr, signature, data) in _windowed(test_result_dirs, start, workers + 1):
+                if isinstance(data, Future):
+                    data = data.result()
+                    if signature is not None:
+                        cache.store(str(tr.path), test, method, signature, data)
+                yield d, tr, data
+    elif executor == "thread":
+        def scan_and_read(d):
+            tr = scan(d)
+            return tr, read(tr)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for d, future in _windowed(test_result_dirs, lambda d: pool.submit(scan_and_read, d), workers + 1):
+                tr, data = future.result()
+                yield d, tr, data
+    else:
+        raise ValueError(f"Unknown executor {executor}, use 'thread' or 'process'")
+
+
+def keep_latest_per_sn(frames: list[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Concatenates the per-directory frames (given in timestamp order) once and keeps,
+    for every SN, only the rows of the newest directory the SN appears in.
+    """
+    if len(frames) == 0:
+        return pd.DataFrame(columns=["SN"])
+    # position of the directory each row comes from
+    run = np.repeat(np.arange(len(frames)), [len(f) for f in frames])
+    merged = pd.concat(frames, ignore_index=True)
+    latest_run = pd.Series(run).groupby(merged["SN"].to_numpy(), dropna=False).transform("max")
+    return merged[run == latest_run.to_numpy()].reset_index(drop=True)
+
+
+# ID columns with few distinct values, stored as categoricals by compact_frame
+category_columns = ["chipID", "channelID", "tacID", "branch", "asic_id", "side", "gain"]
+
+
+def compact_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Downcasts the integer columns and the SN index to the smallest integer type
+    that holds them, stores the columns of category_columns as categoricals if
+    they repeat and keeps the pass/fail flags bool (the nullable boolean type
+    if some are missing). Float columns keep their type, the cuts are
+    evaluated on them.
+    """
+    compact = {}
+    for col in df.columns:
+        series = df[col]
+        if col in category_columns and series.nunique() < len(series) / 2:
+            series = series.astype("category")
+        elif pd.api.types.is_integer_dtype(series.dtype):
+            series = pd.to_numeric(series, downcast="integer")
+        elif series.dtype == object and series.dropna().map(type).isin([bool, np.bool_]).all():
+            # flags that turned into objects when they were concatenated with missing values
+            series = series.astype("boolean") if series.isna().any() else series.astype(bool)
+        compact[col] = series
+    compact = pd.DataFrame(compact, index=df.index)
+    if pd.api.types.is_integer_dtype(compact.index.dtype):
+        compact.index = pd.Index(pd.to_numeric(compact.index, downcast="integer"), name=df.index.name)
+    return compact
+
+
+def memory_report(test: str,
+                  before: pd.DataFrame,
+                  after: pd.DataFrame) -> None:
+    before_mb = before.memory_usage(deep=True).sum() / 1e6
+    after_mb = after.memory_usage(deep=True).sum() / 1e6
+    print(f"{test}: {before_mb:.2f} MB -> {after_mb:.2f} MB "
+          f"({after_mb / before_mb:.0%})" if before_mb > 0 else f"{test}: empty")
+
+
 class YieldComputer:
     
     def __init__(self,
                  tests: list,
-                 base_dir: str | Path) -> None:
+                 base_dir: str | Path,
+                 registry: TestResultRegistry | None = None,
+                 workers: int = 1,
+                 executor: str = "thread",
+                 cache: ResultCache | None = None,
+                 pass_only: bool = True,
+                 discovery: RunDiscovery | None = None) -> None:
         self.tests = tests
         self.base_dir = base_dir
-        
-        def get_test_result_dirs(base_dir: str):
-
-            test_result_dirs = [d for d in Path(base_dir).glob("2024*") if d.is_dir()]
-            # assert that the dirs are sorted by their timestamps (yyyymmddhhmm)
-            test_result_dirs = sorted(test_result_dirs, key=lambda x: int((x.stem).strip("_")))
-            # filter out the dirs that do not contain a file called "detailed_results.tsv"
-            test_result_dirs = [d for d in test_result_dirs if (d / "detailed_results.tsv").exists()]
-            sn_regex = re.compile(r"SN_3211[\s_]0[\s_]03[\s_]0[\s_]00[\s_]([\d]+)\.txt")
-            test_result_dirs_good_format = [d for d in test_result_dirs if
-                            len(sn_regex.findall("".join([str(p) for p in Path(d).rglob("SN_3211*.txt")]))) >= 1]
-            print(f"Found {len(test_result_dirs_good_format)} directories with the correct format")
-            test_result_dirs_bad_format = [d for d in test_result_dirs if d not in test_result_dirs_good_format]
-            test_result_dirs_bad_format = [str(d)+"\n" for d in test_result_dirs_bad_format]
-            print(f"bad format dirs: {test_result_dirs_bad_format}") 
-            return sorted(test_result_dirs_good_format, key=lambda x: int(x.stem))
-        self.test_result_dirs = get_test_result_dirs(self.base_dir)
+        self.registry = registry if registry is not None else TestResultRegistry()
+        self.workers = workers
+        self.executor = executor
+        self.cache = cache
+        # only read the columns the cuts need, the per-cut failure counts come along
+        self.method = "get_pass_only_info" if pass_only else "get_passing_info"
+        # shared with the other computers of a run to only discover the directories once
+        self.discovery = discovery if discovery is not None else RunDiscovery(base_dir)
+        self.test_result_dirs = self.discovery.discover()
 
 
     def merge_dataframes_for_test(self,
                                   test: str):
-        merged_dataframe = pd.DataFrame()
+        frames = []
         skipped = []
-        for d in self.test_result_dirs:
-            try: 
-                tr = TestResult(path=d)
-            except FileNotFoundError as e:
+        for d, tr, data in read_test_result_dirs(self.test_result_dirs, test, self.method,
+                                                 self.registry, self.workers, self.executor,
+                                                 self.cache):
+            if tr is None:
                 skipped.append(d)
                 continue
-            data = tr.get_passing_info(test)
             if data is None:
                 print(f"Couldn't retrieve data for {d}")
                 skipped.append(d)
                 continue
-            if not merged_dataframe.empty and any(data["SN"].isin(merged_dataframe["SN"])):
-                merged_dataframe = merged_dataframe[~merged_dataframe["SN"].isin(data["SN"])]
-            merged_dataframe = pd.concat([merged_dataframe, data], ignore_index=True)
-        merged_dataframe.set_index("SN", inplace=True)
+            frames.append(data)
+        # SNs that were tested again are taken from the newest directory
+        with profiling.stage("merge", test=test) as record:
+            merged_dataframe = keep_latest_per_sn(frames)
+            merged_dataframe.set_index("SN", inplace=True)
+            record["rows"] = len(merged_dataframe)
         print(f"Skipped the following directories: \n")
         print(" \n".join([str(d) for d in skipped]))
         return merged_dataframe
@@ -175,7 +489,8 @@ class YieldComputer:
         result = []
         for test in self.tests:
             print(f"Processing test {test}")
-            result.append(self.merge_dataframes_for_test(test).rename(columns={"test_pass": f"{test}_pass"}))
+            passing = self.merge_dataframes_for_test(test)[["test_pass"]]
+            result.append(passing.rename(columns={"test_pass": f"{test}_pass"}))
         return pd.concat(result, axis=1)
 
 
@@ -183,53 +498,120 @@ class Plotter:
     
     def __init__(self,
                  tests: list,
-                 base_dir: str | Path) -> None:
+                 base_dir: str | Path,
+                 registry: TestResultRegistry | None = None,
+                 workers: int = 1,
+                 executor: str = "thread",
+                 cache: ResultCache | None = None,
+                 discovery: RunDiscovery | None = None,
+                 history: RetestHistory | None = None) -> None:
         self.tests = tests
         self.base_dir = base_dir
-        
-        def get_test_result_dirs(base_dir: str):
-
-            test_result_dirs = [d for d in Path(base_dir).glob("2024*") if d.is_dir()]
-            # assert that the dirs are sorted by their timestamps (yyyymmddhhmm)
-            test_result_dirs = sorted(test_result_dirs, key=lambda x: int((x.stem).strip("_")))
-            # filter out the dirs that do not contain a file called "detailed_results.tsv"
-            test_result_dirs = [d for d in test_result_dirs if (d / "detailed_results.tsv").exists()]
-            sn_regex = re.compile(r"SN_3211[\s_]0[\s_]03[\s_]0[\s_]00[\s_]([\d]+)\.txt")
-            test_result_dirs_good_format = [d for d in test_result_dirs if
-                            len(sn_regex.findall("".join([str(p) for p in Path(d).rglob("SN_3211*.txt")]))) >= 1]
-            print(f"Found {len(test_result_dirs_good_format)} directories with the correct format")
-            test_result_dirs_bad_format = [d for d in test_result_dirs if d not in test_result_dirs_good_format]
-            test_result_dirs_bad_format = [str(d)+"\n" for d in test_result_dirs_bad_format]
-            print(f"bad format dirs: {test_result_dirs_bad_format}") 
-            return sorted(test_result_dirs_good_format, key=lambda x: int(x.stem))
-
-        self.test_result_dirs = get_test_result_dirs(self.base_dir)
+        self.registry = registry if registry is not None else TestResultRegistry()
+        self.workers = workers
+        self.executor = executor
+        self.cache = cache
+        # SN -> run directory the merged rows were taken from, per test
+        self.sources = {}
+        # if given, the pass status of every board in every run is recorded before the merge drops the older runs
+        self.history = history
+        # shared with the other computers of a run to only discover the directories once
+        self.discovery = discovery if discovery is not None else RunDiscovery(base_dir)
+        self.test_result_dirs = self.discovery.discover()
 
 
     def merge_dataframes_for_test(self,
                                   test: str):
-        merged_dataframe = pd.DataFrame()
+        frames = []
         skipped = []
-        for d in self.test_result_dirs:
-            try: 
-                tr = TestResult(path=d)
-            except FileNotFoundError as e:
+        dirs = []
+        for d, tr, data in read_test_result_dirs(self.test_result_dirs, test, "get_data",
+                                                 self.registry, self.workers, self.executor,
+                                                 self.cache):
+            if tr is None:
                 skipped.append(d)
                 continue
-            data = tr.get_data(test)
             if data is None:
                 print(f"Couldn't retrieve data for {d}")
                 skipped.append(d)
                 continue
-            if not merged_dataframe.empty and any(data["SN"].isin(merged_dataframe["SN"])):
-                merged_dataframe = merged_dataframe[~merged_dataframe["SN"].isin(data["SN"])]
-            merged_dataframe = pd.concat([merged_dataframe, data], ignore_index=True)
+            frames.append(data)
+            dirs.append(str(d))
+            if self.history is not None:
+                self.history.add(test, d, data)
+        # SNs that were tested again are taken from the newest directory
+        with profiling.stage("merge", test=test) as record:
+            merged_dataframe = keep_latest_per_sn(frames)
+            record["rows"] = len(merged_dataframe)
+        if len(frames) > 0:
+            run_dirs = pd.Series(np.repeat(dirs, [len(f) for f in frames]),
+                                 index=np.concatenate([f["SN"].to_numpy() for f in frames]))
+            self.sources[test] = run_dirs.groupby(level=0).last()
         merged_dataframe.set_index("SN", inplace=True)
         print(f"Skipped the following directories: \n")
         print(" \n".join([str(d) for d in skipped]))
         return merged_dataframe
 
 
+    def stream_merge_for_test(self,
+                              test: str,
+                              store: ResultStore,
+                              spool_dir: str | Path) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        Same merge as merge_dataframes_for_test, written straight to the store
+        instead of being returned. The parsed frame of every directory is
+        spooled to disk while a map SN -> newest directory is kept, then every
+        spooled frame is read back, reduced to the SNs it is the newest
+        directory of and written to the store as one chunk. Only one
+        directory's data is held at a time (workers + 1 if workers > 1, see
+        read_test_result_dirs).
+        Returns the locations of the rows in the store (see
+        ResultStore.write_test) and the first row of every SN.
+        """
+        spool_dir = Path(spool_dir) / test
+        if spool_dir.exists():
+            shutil.rmtree(spool_dir)
+        spool_dir.mkdir(parents=True)
+        spooled = []
+        skipped = []
+        # SN -> position of the newest directory in spooled
+        latest = {}
+        for d, tr, data in read_test_result_dirs(self.test_result_dirs, test, "get_data",
+                                                 self.registry, self.workers, self.executor,
+                                                 self.cache):
+            if tr is None:
+                skipped.append(d)
+                continue
+            if data is None:
+                print(f"Couldn't retrieve data for {d}")
+                skipped.append(d)
+                continue
+            if self.history is not None:
+                self.history.add(test, d, data)
+            spool_file = spool_dir / f"{len(spooled)}.parquet"
+            data.to_parquet(spool_file, index=False)
+            latest.update(dict.fromkeys(data["SN"].unique().tolist(), len(spooled)))
+            spooled.append((d, spool_file))
+        print(f"Skipped the following directories: \n")
+        print(" \n".join([str(d) for d in skipped]))
+
+        first_rows = []
+        def chunks():
+            for run, (d, spool_file) in enumerate(spooled):
+                data = pd.read_parquet(spool_file)
+                spool_file.unlink()
+                # SNs that were tested again are taken from the newest directory
+                data = data[data["SN"].map(latest).to_numpy() == run].set_index("SN")
+                first_rows.append(data.groupby("SN").head(1))
+                yield data
+        locations = store.write_test_chunks(test, chunks())
+        shutil.rmtree(spool_dir)
+        self.sources[test] = pd.Series({sn: str(spooled[run][0]) for sn, run in latest.items()}, dtype=object)
+        if len(first_rows) == 0:
+            return locations, pd.DataFrame(columns=["SN"]).set_index("SN")
+        return locations, pd.concat(first_rows)
+
+
 def make_parser():
     import argparse
     parser = argparse.ArgumentParser(description="Get tables for TOFHIR2C calibration tests")
@@ -248,30 +630,132 @@ def make_parser():
                         type=str,
                         default="output",
                         help="Output directory")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=1,
+                        help="Number of run directories to parse in parallel")
+    parser.add_argument("--executor",
+                        type=str,
+                        choices=["thread", "process"],
+                        default="thread",
+                        help="Pool used to parse the run directories if workers > 1")
+    parser.add_argument("--engine",
+                        type=str,
+                        choices=["c", "pyarrow"],
+                        default="c",
+                        help="pandas read_csv engine used to parse the test files")
+    parser.add_argument("--cuts",
+                        type=str,
+                        default=None,
+                        help="Table with the pass/fail criteria of the tests (default: cuts.csv)")
+    parser.add_argument("--cache_dir",
+                        type=str,
+                        default=None,
+                        help="Directory of the per run directory result cache (default: <output_dir>/cache)")
+    parser.add_argument("--no_cache",
+                        action="store_true",
+                        help="Parse every run directory again instead of using the result cache")
+    parser.add_argument("--format",
+                        type=str,
+                        choices=["parquet", "hdf5"],
+                        default="parquet",
+                        help="Output format: one partitioned Parquet dataset (<output_dir>/dataset) or one HDF5 file per test")
+    parser.add_argument("--stream",
+                        action="store_true",
+                        help="Merge the per-channel tests directory by directory with bounded memory (parquet format only)")
+    parser.add_argument("--profile",
+                        action="store_true",
+                        help="Record the time, bytes, files and rows of every stage, test and directory")
+    parser.add_argument("--trends",
+                        type=str,
+                        default=None,
+                        metavar="FREQ",
+                        help="Also write the yield per time bin (pandas period frequency, e.g. W) and tester slot")
+    parser.add_argument("--yield_policy",
+                        type=str,
+                        choices=yield_policies,
+                        default="latest",
+                        help="Pass status of a retested board: of its newest run, its first run or passed in any run")
+    parser.add_argument("--no_compact",
+                        action="store_true",
+                        help="Keep the merged frames with the dtypes they were parsed with")
     return parser
 
 
 def main(base_dir: str,
          tests: list[str],
-         output_dir: str = "output"):
+         output_dir: str = "output",
+         workers: int = 1,
+         executor: str = "thread",
+         use_cache: bool = True,
+         cache_dir: str | None = None,
+         engine: str = "c",
+         cuts: str | None = None,
+         output_format: str = "parquet",
+         stream: bool = False,
+         profile: bool = False,
+         compact: bool = True,
+         trends: str | None = None,
+         yield_policy: str = "latest"):
     
-    tests_to_run = [test for test in tests]
-    # if so, don't process them again (if overwrite is False)
-    if os.path.exists(f"{output_dir}"):
-        existing_tests = [str(f.stem).replace(".h5", "") for f in Path(f"{output_dir}").rglob("*.h5")] 
-        for test in tests:
-            if test in existing_tests:
-                print(f"Test {test} already processed. Skipping...")
-                tests_to_run.remove(test)
+    # stage timings, bytes, files and rows per test and directory, written to <output_dir>/profile.*
+    profiler = profiling.enable() if profile else None
+    if stream and output_format != "parquet":
+        raise ValueError("The streaming merge needs the parquet output format")
+    if yield_policy not in yield_policies:
+        raise ValueError(f"Unknown yield policy {yield_policy}, use one of {yield_policies}")
+    # the parsed frames are cached per run directory and test, so that
+    # only new or changed directories are parsed before merging again
+    cache = None
+    discovery = RunDiscovery(base_dir)
+    if use_cache:
+        cache_dir = cache_dir if cache_dir is not None else f"{output_dir}/cache"
+        cache = ResultCache(cache_dir)
+        # only new or changed run directories are validated again
+        discovery = RunDiscovery(base_dir, f"{cache_dir}/discovery.json")
 
     print("Running Plotter")
-    p = Plotter(tests=tests_to_run, base_dir=base_dir)
+    cut_table = CutTable.from_csv(cuts) if cuts is not None else None
+    registry = TestResultRegistry(engine=engine, cut_table=cut_table, discovery=discovery)
+    # every run of every board, the yield is taken from it with yield_policy
+    history = RetestHistory()
+    with profiling.stage("discovery", directory=base_dir) as record:
+        p = Plotter(tests=tests, base_dir=base_dir, registry=registry,
+                    workers=workers, executor=executor, cache=cache, discovery=discovery,
+                    history=history)
+        record["files"] = len(p.test_result_dirs)
+    discovery.save()
+    discovery.report()
+    # all tests and the yield go to one dataset partitioned by test and SN range
+    store = ResultStore(f"{output_dir}/dataset") if output_format == "parquet" else None
+    locations = {}
     merged_dfs = {}
-    for test in tqdm(tests_to_run):
-        merged_dfs[test] = p.merge_dataframes_for_test(test)
+    for test in tqdm(tests):
+        if stream and test in streaming_tests:
+            # written to the store directory by directory, only the first row of every SN is kept here
+            locations[test], merged = p.stream_merge_for_test(test, store, f"{output_dir}/spool")
+        else:
+            merged = p.merge_dataframes_for_test(test)
+        if compact:
+            # compacted right away, so that only one full size frame is held at a time
+            merged_dfs[test] = compact_frame(merged)
+            memory_report(test, merged, merged_dfs[test])
+        else:
+            merged_dfs[test] = merged
+        del merged
+    if stream:
+        shutil.rmtree(f"{output_dir}/spool", ignore_errors=True)
+    registry.report()
+    if cache is not None:
+        # saved once for all tests, without the directories that are gone
+        cache.prune(base_dir, p.test_result_dirs)
+        cache.save()
+        cache.report()
+    if workers <= 1 or executor == "thread":
+        # the files parsed in the workers of a process pool are not counted here
+        report_parse_counts()
 
 
-    yield_dfs = {}
     # keep track of the unique SNs
     unique_sns = {} 
     for test, df in merged_dfs.items():
@@ -279,23 +763,48 @@ def main(base_dir: str,
             os.makedirs(f"{output_dir}")
         #df.to_csv(f"{output_dir}/testdata/{test}.csv")
         unique_sns[test] = sorted(df.index.unique().to_list())
-        df.to_hdf(f"{output_dir}/{test}.h5", key='data', mode='w', format='table', data_columns=True)
-        # if a SN has one "pass", all are "pass"
-        if not test in ["TestPulse", "ExtTestPulse"]:
-            yield_dfs[test] = (df["test_pass"].rename(f"{test}_pass")).groupby("SN").first()
-
-    # for all tests, that were not processed, load the data from the existing files
-    for test in tests:
-        if test not in tests_to_run:
-            data = pd.read_hdf(f"{output_dir}/{test}.h5", key='data')
-            if not test in ["TestPulse", "ExtTestPulse"]:
-                # if a SN has one "pass", all are "pass"
-                yield_dfs[test] = (data["test_pass"].rename(f"{test}_pass")).groupby("SN").first()
-                unique_sns[test] = sorted(data.index.unique().to_list())
-    
-    yield_df = pd.concat(yield_dfs.values(), axis=1)
-    yield_df.to_hdf(f"{output_dir}/yield.h5", key='data', mode='w', format='table')
-    
+        with profiling.stage("write", test=test) as record:
+            if store is not None:
+                # the streamed tests are already in the store
+                if test not in locations:
+                    locations[test] = store.write_test(test, df)
+            else:
+                df.to_hdf(f"{output_dir}/{test}.h5", key='data', mode='w', format='table', data_columns=True)
+            record["rows"] = len(df)
+
+
+    # a board passes a test in a run if all its rows pass, its runs are reduced with the yield policy
+    history.report()
+    history.save(f"{output_dir}/history.parquet")
+    yield_tests = [test for test in merged_dfs if test not in ["TestPulse", "ExtTestPulse"]]
+    yield_dfs = history.yield_series(yield_policy, yield_tests)
+    # pass/fail/missing of every board as bitmasks, the yield table is built from them
+    yields = YieldMatrix.from_series(yield_dfs)
+    yields.summary()
+    yield_df = yields.to_frame()
+    with profiling.stage("write", test="yield") as record:
+        if store is not None:
+            locations["yield"] = store.write_test("yield", yield_df)
+            # SN -> source run directory and rows in every test, for get_tables.py board <SN>
+            store.write_board_index(locations, p.sources)
+        else:
+            # HDF5 tables can't hold bool columns with missing values, those are written as 1.0/0.0/NaN
+            missing = [col for col in yield_df.columns if yield_df[col].dtype == object]
+            yield_df.astype({col: "float32" for col in missing}).to_hdf(f"{output_dir}/yield.h5", key='data',
+                                                                        mode='w', format='table')
+        record["rows"] = len(yield_df)
+
+    if trends is not None:
+        # per-directory counts are kept in the output directory, only new or changed runs are reduced from the history
+        with profiling.stage("trends", directory=base_dir):
+            yield_trends = YieldTrends(f"{output_dir}/trends.parquet",
+                                       [test for test in tests if test not in ["TestPulse", "ExtTestPulse"]])
+            yield_trends.update(history, p.test_result_dirs, registry)
+            yield_trends.save()
+        yield_trends.report()
+        yield_trends.trend(trends).to_csv(f"{output_dir}/yield_trends.csv")
+        print(f"Yield per {trends} and tester slot written to {output_dir}/yield_trends.csv")
+
     # check if the unique SNs are the same for all tests
     if not all(len(sns) == len(unique_sns["Aldo"]) for sns in unique_sns.values()):
         print("WARNING: Unique SNs are not the same for all tests")
@@ -312,9 +821,56 @@ def main(base_dir: str,
         with open(f"{output_dir}/unique_sns.pkl", "wb") as file:
             pickle.dump(unique_sns["Aldo"], file)
 
+    if profiler is not None:
+        if workers > 1 and executor == "process":
+            print("The parsing in the workers of a process pool isn't profiled")
+        profiler.print_summary()
+        profiler.write_report(output_dir)
+        profiling.disable()
+
+
+def board_main(argv: list[str]):
+    """
+    get_tables.py board <SN> [--output_dir ...] [--tests ...]
+    Prints the source run directory and the rows of one board in every test,
+    read through the board index of the dataset written by main
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="get_tables.py board",
+                                     description="Show the rows of one board in all tests")
+    parser.add_argument("sn",
+                        type=int,
+                        help="Serial number of the board")
+    parser.add_argument("--output_dir",
+                        type=str,
+                        default="output",
+                        help="Output directory of get_tables.py")
+    parser.add_argument("--tests",
+                        type=str,
+                        nargs="+",
+                        default=None,
+                        help="Tests to show (default: all)")
+    args = parser.parse_args(argv)
+    store = ResultStore(f"{args.output_dir}/dataset")
+    info = store.board_info(args.sn)
+    if args.tests is not None:
+        info = info[info["test"].isin(args.tests)]
+    if len(info) == 0:
+        raise ValueError(f"SN {args.sn} not found in the board index")
+    print(info[["test", "run_dir", "timestamp", "length"]].to_string(index=False))
+    for test, data in store.read_board(args.sn, args.tests).items():
+        print(f"\n{test}: {len(data)} rows")
+        print(data.to_string())
+
 
 if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "board":
+        board_main(sys.argv[2:])
+        sys.exit()
     parser = make_parser()
     args = parser.parse_args()
-    main(args.base_dir, args.tests, args.output_dir)
+    main(args.base_dir, args.tests, args.output_dir, args.workers, args.executor,
+         not args.no_cache, args.cache_dir, args.engine, args.cuts, args.format, args.stream,
+         args.profile, not args.no_compact, args.trends, args.yield_policy)
 
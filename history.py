@@ -0,0 +1,160 @@
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from discovery import RunDiscovery
+from store import write_atomically
+
+
+# policies to reduce the runs of a board to one pass status per test, see RetestHistory.view
+yield_policies = ["latest", "first", "any_pass"]
+
+
+class RetestHistory:
+    """
+    Pass status of every board in every run it appeared in, per test.
+
+    The merge keeps only the newest run of a retested board, the history
+    keeps one row per (test, SN, run) with the run directory, its timestamp
+    and whether all rows of the board passed. The rows are sorted by test,
+    SN and run_order (the digits the run directory name starts with, the
+    order of RunDiscovery.discover and so of the merge), so the runs of a
+    board are contiguous and in time order: the latest, first and any-pass
+    views are one vectorized pass over the sorted rows. timestamp is only
+    shown, it is NaT for names that aren't yyyymmddhhmm. Test and run directory are stored as categoricals,
+    the history of millions of runs stays small in memory and on disk.
+    """
+
+    columns = ["test", "SN", "run_dir", "run_order", "timestamp", "passed"]
+
+    def __init__(self,
+                 history: pd.DataFrame | None = None) -> None:
+        # frames added since the history was last sorted
+        self._pending = []
+        if history is None:
+            history = pd.DataFrame({"test": pd.Categorical([]),
+                                    "SN": pd.Series(dtype="int64"),
+                                    "run_dir": pd.Categorical([]),
+                                    "run_order": pd.Series(dtype="int64"),
+                                    "timestamp": pd.Series(dtype="datetime64[ns]"),
+                                    "passed": pd.Series(dtype=bool)})
+        if "run_order" not in history.columns:
+            # histories written before the run order was recorded
+            history = history.assign(run_order=history["run_dir"].astype(str).map(RunDiscovery.timestamp)
+                                     .astype("int64"))
+            history = history.sort_values(["test", "SN", "run_order", "run_dir"], kind="stable")
+        self._history = history[self.columns]
+
+
+    def add(self,
+            test: str,
+            run_dir: str | Path,
+            data: pd.DataFrame) -> None:
+        # records the pass status of the boards in data (SN and test_pass per row) in one run
+        if "test_pass" not in data.columns or len(data) == 0:
+            return
+        passed = data.groupby("SN", sort=False)["test_pass"].all()
+        self._pending.append(pd.DataFrame({"test": test,
+                                           "SN": passed.index.to_numpy(dtype=np.int64),
+                                           "run_dir": str(run_dir),
+                                           "run_order": RunDiscovery.timestamp(run_dir),
+                                           "timestamp": RunDiscovery.run_time(run_dir),
+                                           "passed": passed.to_numpy(dtype=bool)}))
+
+
+    @property
+    def history(self) -> pd.DataFrame:
+        """
+        All rows sorted by test, SN and run_order. A run that was added twice
+        for a test (e.g. read again after a change) keeps its last rows.
+        """
+        if len(self._pending) > 0:
+            history = pd.concat([self._history.astype({"test": str, "run_dir": str}), *self._pending],
+                                ignore_index=True)
+            history = history.drop_duplicates(["test", "SN", "run_dir"], keep="last")
+            history = history.sort_values(["test", "SN", "run_order", "run_dir"], kind="stable")
+            self._history = history.astype({"test": "category", "SN": "int64", "run_dir": "category",
+                                             "run_order": "int64", "passed": bool}).reset_index(drop=True)
+            self._pending = []
+        return self._history
+
+
+    def _boards(self) -> tuple[pd.DataFrame, np.ndarray]:
+        # the sorted history and the position of the first row of every (test, SN)
+        history = self.history
+        test = history["test"].cat.codes.to_numpy()
+        sn = history["SN"].to_numpy()
+        new_board = np.ones(len(history), dtype=bool)
+        new_board[1:] = (test[1:] != test[:-1]) | (sn[1:] != sn[:-1])
+        return history, np.flatnonzero(new_board)
+
+
+    def view(self,
+             policy: str = "latest") -> pd.DataFrame:
+        """
+        One row per test and SN with the pass status chosen by policy:
+        "latest" the newest run, "first" the first run, "any_pass" passed in
+        any run. run_dir and timestamp are those of the run the status was
+        taken from (for any_pass the first passing run, or the latest if
+        none passed), runs is the number of runs of the board.
+        """
+        if policy not in yield_policies:
+            raise ValueError(f"Unknown yield policy {policy}, use one of {yield_policies}")
+        history, starts = self._boards()
+        if len(history) == 0:
+            return pd.DataFrame(columns=["run_dir", "timestamp", "passed", "runs"],
+                                index=pd.MultiIndex.from_arrays([[], []], names=["test", "SN"]))
+        ends = np.append(starts[1:], len(history))
+        if policy == "first":
+            rows = starts
+        elif policy == "latest":
+            rows = ends - 1
+        else:
+            passed = history["passed"].to_numpy()
+            any_pass = np.logical_or.reduceat(passed, starts)
+            # first passing row of every board, rows are only searched inside the board
+            position = np.arange(len(history))
+            first_pass = np.minimum.reduceat(np.where(passed, position, len(history)), starts)
+            rows = np.where(any_pass, first_pass, ends - 1)
+        view = history.iloc[rows].set_index(["test", "SN"])[["run_dir", "timestamp", "passed"]]
+        view["runs"] = ends - starts
+        return view
+
+
+    def yield_series(self,
+                     policy: str = "latest",
+                     tests: list[str] | None = None) -> dict[str, pd.Series]:
+        # SN -> pass per test under the policy, see YieldMatrix.from_series
+        passed = self.view(policy)["passed"]
+        tests = tests if tests is not None else passed.index.get_level_values("test").unique().tolist()
+        return {test: passed.xs(test, level="test") if test in passed.index.get_level_values("test")
+                else pd.Series(dtype=bool, index=pd.Index([], name="SN", dtype="int64"))
+                for test in tests}
+
+
+    def retests(self) -> pd.DataFrame:
+        # boards tested more than once per test, with the status of their first and latest run
+        first = self.view("first")
+        latest = self.view("latest")
+        retested = latest["runs"] > 1
+        return pd.DataFrame({"runs": latest["runs"][retested],
+                             "first_passed": first["passed"][retested],
+                             "latest_passed": latest["passed"][retested]})
+
+
+    def save(self,
+             path: str | Path) -> None:
+        history = self.history
+        write_atomically(path, lambda tmp_file: history.to_parquet(tmp_file, index=False))
+
+
+    @classmethod
+    def load(cls,
+             path: str | Path) -> "RetestHistory":
+        return cls(pd.read_parquet(path))
+
+
+    def report(self) -> None:
+        history, starts = self._boards()
+        print(f"Retest history: {len(history)} runs of {len(starts)} boards and tests, "
+              f"{int((np.diff(np.append(starts, len(history))) > 1).sum())} retested")
@@ -4,6 +4,9 @@ import numpy as np
 from glob import glob
 from pathlib import Path
 
+from store import ResultStore, write_atomically
+from yield_engine import YieldMatrix, pass_column_test
+
 #from tests import *
 #
 #test_map = {"Aldo": Aldo,
@@ -206,11 +209,122 @@ baseurl = "http://localhost:8501"
 #                          "TDCCalibration"],
 #                   base_dir="/eos/user/a/aboletti/TOFHIR2C_validation/tmp_calibration_data")
 
-yield_df = pd.read_csv("yield.csv", index_col="SN") 
+# yield table of all boards, a compact Parquet copy (yield.parquet) is written
+# next to it the first time it is read after a change
+yield_file = Path("yield.csv")
+# dataset written by get_tables.py, holds the detailed data of every board
+dataset_dir = Path("output/dataset")
+page_size = 100
+
+
+@st.cache_resource(max_entries=2)
+def load_yield_df(path: str,
+                  mtime_ns: int) -> pd.DataFrame:
+    # mtime_ns is part of the cache key, a changed file is read again.
+    # The frame is shared read-only by all sessions, without a copy per rerun
+    store = Path(path).with_suffix(".parquet")
+    if store.exists() and store.stat().st_mtime_ns >= mtime_ns:
+        return pd.read_parquet(store)
+    yield_df = pd.read_csv(path, index_col="SN")
+    try:
+        # other sessions may read the store meanwhile
+        write_atomically(store, yield_df.to_parquet)
+    except OSError as e:
+        print(f"Couldn't write {store}: {e}")
+    return yield_df
+
+
+@st.cache_resource(max_entries=2)
+def load_yield_matrix(path: str,
+                      mtime_ns: int) -> YieldMatrix:
+    # pass/fail/missing bitmasks of the yield table, the aggregates and filters are computed on them
+    return YieldMatrix.from_frame(load_yield_df(path, mtime_ns))
+
+
+@st.cache_data(max_entries=2)
+def get_yield_aggregates(path: str,
+                         mtime_ns: int) -> tuple[pd.DataFrame, float, pd.DataFrame]:
+    # per test and overall yield and the failure combinations, computed once per version of the yield table
+    yields = load_yield_matrix(path, mtime_ns)
+    yield_map_df = yields.test_yields().map("{:.2%}".format).rename("Yield").rename_axis("Test").to_frame()
+    return yield_map_df, yields.overall_yield(), yields.failure_combinations()
+
+
+@st.cache_resource(max_entries=2)
+def load_run_dates(path: str,
+                   mtime_ns: int) -> pd.Series:
+    # SN -> date of the newest run the board was taken from, from the board index
+    index = pd.read_parquet(path, columns=["SN", "timestamp"])
+    return index.groupby("SN")["timestamp"].max().dt.date
+
+
+@st.cache_data(max_entries=64)
+def filter_boards(path: str,
+                  mtime_ns: int,
+                  failing_tests: tuple[str, ...],
+                  sn_range: tuple[int, int],
+                  date_range: tuple | None = None,
+                  index_path: str | None = None,
+                  index_mtime_ns: int | None = None) -> np.ndarray:
+    """
+    SNs of the boards that fail any of failing_tests (all boards if empty),
+    lie in sn_range and, if given, whose newest run is in date_range.
+    Only the SNs are cached and sent on, the rows are sliced per page.
+    """
+    yield_df = load_yield_df(path, mtime_ns)
+    yields = load_yield_matrix(path, mtime_ns)
+    keep = (yield_df.index >= sn_range[0]) & (yield_df.index <= sn_range[1])
+    if len(failing_tests) > 0:
+        # boards without a result for a test don't fail it
+        failing = pd.Series(yields.failing_any([pass_column_test(col) for col in failing_tests]), index=yields.sns)
+        keep &= failing.reindex(yield_df.index, fill_value=False).to_numpy()
+    if date_range is not None and index_path is not None:
+        run_dates = load_run_dates(index_path, index_mtime_ns).reindex(yield_df.index)
+        keep &= ((run_dates >= date_range[0]) & (run_dates <= date_range[1])).to_numpy()
+    return yield_df.index[keep].to_numpy()
+
+
+@st.cache_data(max_entries=32)
+def load_board(sn: int,
+               index_path: str,
+               index_mtime_ns: int) -> dict[str, pd.DataFrame]:
+    # detailed data of one board in all tests, only its rows are read
+    return ResultStore(Path(index_path).parent).read_board(sn)
+
+
+yield_mtime = yield_file.stat().st_mtime_ns
+yield_df = load_yield_df(str(yield_file), yield_mtime)
+yield_map_df, total_yield, failure_combinations = get_yield_aggregates(str(yield_file), yield_mtime)
+
 # Create a placeholder DataFrame
 st.subheader('Summary of all boards')
 
-st.dataframe(yield_df,
+board_index = ResultStore(dataset_dir).index_file
+index_mtime = board_index.stat().st_mtime_ns if board_index.exists() else None
+
+pass_columns = [col for col in yield_df.columns if col.endswith("_pass")]
+filter_cols = st.columns(3)
+failing_tests = filter_cols[0].multiselect("Failing any of", pass_columns)
+sn_min, sn_max = int(yield_df.index.min()), int(yield_df.index.max())
+sn_range = (sn_min, sn_max)
+if sn_min < sn_max:
+    sn_range = filter_cols[1].slider("SN range", sn_min, sn_max, (sn_min, sn_max))
+date_range = None
+if index_mtime is not None:
+    run_dates = load_run_dates(str(board_index), index_mtime).dropna()
+    if len(run_dates) > 0:
+        dates = filter_cols[2].date_input("Run date", (run_dates.min(), run_dates.max()))
+        # the range is incomplete while the second date is being picked
+        date_range = tuple(dates) if len(dates) == 2 else None
+
+sns = filter_boards(str(yield_file), yield_mtime, tuple(failing_tests), tuple(sn_range),
+                    date_range, str(board_index) if index_mtime is not None else None, index_mtime)
+n_pages = max(1, -(-len(sns) // page_size))
+page = st.number_input(f"Page (of {n_pages}, {len(sns)} boards)", min_value=1, max_value=n_pages, value=1)
+page_sns = sns[(page - 1) * page_size:page * page_size]
+
+# only the rows of the visible page are sent to the browser
+st.dataframe(yield_df.loc[page_sns],
              column_config={
                 **{col: col for col in yield_df.columns if col != "link"},
                     "link": st.column_config.LinkColumn("Link"),
@@ -218,16 +332,26 @@ st.dataframe(yield_df,
              hide_index=False,
 )
 
+st.subheader("Board details")
+
+if index_mtime is None:
+    st.write(f"No board index in {dataset_dir}, run get_tables.py to write it")
+elif len(page_sns) > 0:
+    sn = st.selectbox("SN", page_sns)
+    if st.checkbox(f"Load the test data of board {sn}"):
+        for test, data in load_board(int(sn), str(board_index), index_mtime).items():
+            with st.expander(f"{test} ({len(data)} rows)"):
+                st.dataframe(data)
+
 st.subheader("Individual Yields")
 
-yield_map = {col.split("_")[0]: f"{(yield_df[col].sum()/len(yield_df)):.2%}" for col in yield_df.columns if col.endswith("_pass")}
-yield_map_df = pd.DataFrame(yield_map.items(), columns=["Test", "Yield"]).set_index("Test")
 st.dataframe(yield_map_df)
 
 st.subheader("Overall Yield")
 
-test_yield_df = yield_df[[col for col in yield_df if col.endswith("test_pass")]]
-total_yield = (test_yield_df.sum(axis=1) == len(test_yield_df.columns)).sum()/len(test_yield_df)
-
 st.write(f"Overall yield: {total_yield:.2%}")
 
+st.subheader("Failure combinations")
+
+# boards per set of failed tests, the most frequent sets first
+st.dataframe(failure_combinations, hide_index=True)
@@ -3,28 +3,112 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import pandas as pd
 import os
+import hashlib
+import pickle
+import numpy as np
+import matplotlib
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 
-def plot_tdc(data: pd.DataFrame,
-             savepath: str = "") -> None:
-    binnings = {"t0" : [-0.2, 0.3, 50],
+tdc_binnings = {"t0" : [-0.2, 0.3, 50],
                 "a0" : [20, 120, 50],
                 "a1" : [450, 650, 50],
                 "a2" : [-20, 1, 21],
                 "sigma": [0.002, 0.01, 40]}
 
+
+class HistogramAggregate:
+    """
+    Histograms of the columns in binnings (column -> [start, stop, bins]),
+    each with an SN axis, a category axis (e.g. branch) and the column axis.
+
+    fill() fills all of them in one pass per column, without selecting the
+    rows of every category. Partial aggregates, e.g. one per run directory,
+    are combined with update() in timestamp order: the SNs of the newer
+    partial replace the same SNs in the aggregate, so that retested boards
+    only count once. The aggregate can be saved and updated with new run
+    directories later, without reading the old ones again.
+    """
+
+    def __init__(self,
+                 binnings: dict,
+                 category: str = "branch") -> None:
+        self.binnings = binnings
+        self.category = category
+        self.histograms = {}
+
+
+    def _new_histogram(self,
+                       col: str) -> Hist:
+        start, stop, bins = self.binnings[col]
+        return (Hist.new.IntCategory([], growth=True, name="SN")
+                .IntCategory([], growth=True, name=self.category)
+                .Regular(bins=bins, start=start, stop=stop, name=col, underflow=True, overflow=True)
+                .Double())
+
+
+    def fill(self,
+             data: pd.DataFrame) -> "HistogramAggregate":
+        # the SN is a column or the index of the merged frames
+        serials = data["SN"] if "SN" in data.columns else data.index
+        serials = np.asarray(serials, dtype=np.int64)
+        categories = data[self.category].to_numpy(dtype=np.int64)
+        for col in self.binnings:
+            if col not in self.histograms:
+                self.histograms[col] = self._new_histogram(col)
+            self.histograms[col].fill(**{"SN": serials, self.category: categories, col: data[col].to_numpy()})
+        return self
+
+
+    def update(self,
+               other: "HistogramAggregate") -> "HistogramAggregate":
+        for col, histogram in other.histograms.items():
+            if col not in self.histograms:
+                self.histograms[col] = histogram.copy()
+                continue
+            current = self.histograms[col]
+            # the entries of boards that were tested again are replaced
+            retested = set(other.serials(col))
+            replaced = [i for i, sn in enumerate(current.axes["SN"]) if sn in retested]
+            current.view(flow=True)[replaced] = 0
+            self.histograms[col] = current + histogram
+        return self
+
+
+    def serials(self,
+            col: str) -> list[int]:
+        return list(self.histograms[col].axes["SN"])
+
+
+    def project(self,
+                col: str) -> Hist:
+        # category x column histogram of all boards
+        return self.histograms[col].project(self.category, col)
+
+
+    def save(self,
+             path: str | Path) -> None:
+        with open(path, "wb") as file:
+            pickle.dump(self, file)
+
+
+    @staticmethod
+    def load(path: str | Path) -> "HistogramAggregate":
+        with open(path, "rb") as file:
+            return pickle.load(file)
+
+
+def plot_tdc_histograms(aggregate: HistogramAggregate,
+                        savepath: str = ""):
     for col in ['t0', *[f"a{i}" for i in range(0, 3)], 'sigma']:
         stack_dict = {}
         fig, ax = plt.subplots()
-        for bid in data["branch"].unique():
-            hist = Hist.new.Regular(bins=binnings[col][2],
-                                    start=binnings[col][0],
-                                    stop=binnings[col][1],
-                                    name=col,
-                                    underflow=True,
-                                    overflow=True,
-                                    ).Double()
-            hist.fill(data[data["branch"] == bid][f"{col}"])
-            stack_dict[f"Branch:{bid}"] = hist
+        projection = aggregate.project(col)
+        for i, bid in enumerate(projection.axes[aggregate.category]):
+            branch = projection[i, :]
+            # branches left without entries after an update are not drawn
+            if branch.sum(flow=True) > 0:
+                stack_dict[f"Branch:{bid}"] = branch
         stack = Stack.from_dict(stack_dict)
         stack.plot(stack=True,
                     ax=ax,
@@ -41,7 +125,13 @@ def plot_tdc(data: pd.DataFrame,
             plt.savefig( f"{savepath}/tdc_{col}.pdf")
             plt.close()
         else:
-            return fig 
+            return fig
+
+
+def plot_tdc(data: pd.DataFrame,
+             savepath: str = "") -> None:
+    # all branches and columns are histogrammed in one pass, see HistogramAggregate
+    return plot_tdc_histograms(HistogramAggregate(tdc_binnings).fill(data), savepath)
 
 
 
@@ -134,4 +224,93 @@ def plot_disc_calibration(data: pd.DataFrame,
         
 #def plot_pt_1000(data:pd.DataFrame,
                  #savepath: str = "") -> None:
-    
\ No newline at end of file
+    
+
+
+def job_hash(plot_function,
+             data: pd.DataFrame) -> str:
+    # changes with the plot function and with the columns, index or values of the data
+    md5 = hashlib.md5(f"{plot_function.__module__}.{plot_function.__qualname__}".encode())
+    md5.update(str(list(data.columns)).encode())
+    md5.update(pd.util.hash_pandas_object(data, index=True).to_numpy().tobytes())
+    return md5.hexdigest()
+
+
+def stamp_file(plot_function,
+               savepath: str | Path) -> Path:
+    return Path(savepath) / f".{plot_function.__name__}.stamp"
+
+
+def _init_worker() -> None:
+    # the workers never show a figure, they only save them
+    matplotlib.use("Agg", force=True)
+
+
+def _render(plot_function,
+            data: pd.DataFrame,
+            savepath: str | Path) -> str | None:
+    # returns the error message if the job failed
+    open_figures = set(plt.get_fignums())
+    try:
+        plot_function(data, str(savepath))
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    finally:
+        # close every figure the job left open (also the ones it only showed or returned)
+        for num in set(plt.get_fignums()) - open_figures:
+            plt.close(num)
+    return None
+
+
+def render_batch(jobs: list[tuple],
+                 workers: int | None = None,
+                 force: bool = False) -> list[str]:
+    """
+    Renders a list of (plot function, data, savepath) jobs, e.g.
+    (plot_tdc, tdc_data[tdc_data.index == sn], f"plots/{sn}/tdc").
+    The jobs run on a pool of workers processes (default: one per CPU) with
+    the non-interactive Agg backend, every figure a job opens is closed when
+    it is done. With workers <= 1 they run in this process, switched to Agg
+    for the time of the batch (switching closes the open figures). A job whose plot function and data are unchanged since its
+    last successful rendering to savepath is skipped, unless force is set.
+    Returns the status of every job: "rendered", "skipped" or "failed".
+    """
+    workers = workers if workers is not None else os.cpu_count()
+    status = ["skipped"] * len(jobs)
+    # job position -> hash of its inputs, for the jobs that need to be rendered
+    todo = {}
+    for i, (plot_function, data, savepath) in enumerate(jobs):
+        digest = job_hash(plot_function, data)
+        stamp = stamp_file(plot_function, savepath)
+        if not force and stamp.exists() and stamp.read_text() == digest:
+            continue
+        todo[i] = digest
+
+    def finish(i, error):
+        plot_function, _, savepath = jobs[i]
+        if error is not None:
+            print(f"Couldn't render {plot_function.__name__} to {savepath}: {error}")
+            status[i] = "failed"
+            return
+        # the stamp is only written once the plots are complete
+        stamp_file(plot_function, savepath).parent.mkdir(parents=True, exist_ok=True)
+        stamp_file(plot_function, savepath).write_text(todo[i])
+        status[i] = "rendered"
+
+    if workers <= 1:
+        # plt.show blocks under an interactive backend, the jobs run with Agg like in the workers
+        backend = plt.get_backend()
+        plt.switch_backend("Agg")
+        try:
+            for i in todo:
+                finish(i, _render(*jobs[i]))
+        finally:
+            plt.switch_backend(backend)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+            futures = [(i, pool.submit(_render, *jobs[i])) for i in todo]
+            for i, future in futures:
+                finish(i, future.result())
+    print(f"Rendered {status.count('rendered')} plot jobs, skipped {status.count('skipped')} unchanged, "
+          f"{status.count('failed')} failed")
+    return status
@@ -0,0 +1,118 @@
+import json
+import threading
+import time
+import pandas as pd
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class Profiler:
+    """
+    Records the wall time, bytes read, number of files and rows of every
+    stage of a run, per test and per run directory. Stages can be nested
+    (read_csv and aldo_fit run inside parse), their times are not
+    subtracted from each other.
+    """
+
+    def __init__(self) -> None:
+        self.records = []
+        # stages are recorded from the threads of a threaded merge
+        self._lock = threading.Lock()
+
+
+    @contextmanager
+    def stage(self,
+              stage: str,
+              test: str | None = None,
+              directory: str | Path | None = None,
+              path: str | Path | None = None):
+        """
+        Times the body of the with statement. The yielded record can be
+        updated with the number of "rows" (and "files") it processed. With a
+        path the file is counted and its size added to the bytes read.
+        """
+        record = {"stage": stage,
+                  "test": test,
+                  "directory": str(directory) if directory is not None else None,
+                  "files": 0,
+                  "bytes": 0,
+                  "rows": 0}
+        if path is not None:
+            path = Path(path)
+            record["directory"] = record["directory"] or str(path.parent)
+            record["files"] = 1
+            record["bytes"] = path.stat().st_size if path.exists() else 0
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            with self._lock:
+                self.records.append(record)
+
+
+    def to_frame(self) -> pd.DataFrame:
+        with self._lock:
+            return pd.DataFrame(self.records, columns=["stage", "test", "directory", "files",
+                                                       "bytes", "rows", "seconds"])
+
+
+    def summary(self,
+                top: int = 10) -> dict[str, pd.DataFrame]:
+        records = self.to_frame()
+        totals = ["seconds", "files", "bytes", "rows"]
+        # a test of a directory is either parsed or loaded from the result cache
+        reads = records[records["stage"].isin(["parse", "cache_load"])]
+        return {"stages": records.groupby("stage", sort=False)[totals].sum(),
+                "slowest_directories": reads.groupby("directory")[totals].sum().nlargest(top, "seconds"),
+                "slowest_tests": reads.groupby("test")[totals].sum().nlargest(top, "seconds")}
+
+
+    def write_report(self,
+                     output_dir: str | Path) -> None:
+        # profile.csv has one row per recorded stage, profile.json the records and the summary
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        records = self.to_frame()
+        records.to_csv(output_dir / "profile.csv", index=False)
+        summary = {name: json.loads(table.reset_index().to_json(orient="records"))
+                   for name, table in self.summary().items()}
+        with open(output_dir / "profile.json", "w") as file:
+            json.dump({"records": json.loads(records.to_json(orient="records")),
+                       "summary": summary}, file, indent=1)
+        print(f"Profile written to {output_dir}/profile.csv and {output_dir}/profile.json")
+
+
+    def print_summary(self,
+                      top: int = 10) -> None:
+        for name, table in self.summary(top).items():
+            print(f"\n{name}:")
+            print(table.to_string(float_format="{:.3f}".format))
+
+
+# the profiler of the running process, None unless enabled (get_tables.py --profile)
+active = None
+
+
+def enable() -> Profiler:
+    global active
+    active = Profiler()
+    return active
+
+
+def disable() -> None:
+    global active
+    active = None
+
+
+@contextmanager
+def stage(stage: str,
+          test: str | None = None,
+          directory: str | Path | None = None,
+          path: str | Path | None = None):
+    # Profiler.stage of the active profiler, does nothing if profiling is off
+    if active is None:
+        yield {}
+        return
+    with active.stage(stage, test, directory, path) as record:
+        yield record
@@ -0,0 +1,274 @@
+import os
+import shutil
+import time
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+from typing import Callable
+
+
+def write_atomically(path: str | Path,
+                     write: Callable[[Path], None]) -> None:
+    """
+    Writes path with write(tmp_file) to a temporary file next to it, then
+    replaces path with it, so that an interrupted run keeps the old file
+    and readers never see a partly written one.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = path.with_name(f"{path.name}.tmp")
+    write(tmp_file)
+    os.replace(tmp_file, path)
+
+
+class ResultStore:
+    """
+    Partitioned Parquet dataset holding the merged frames of all tests:
+
+    <root>/<test>/sn_bin=<k>/part-<i>.parquet
+
+    Every test is one directory, inside it the rows are split into ranges of
+    sn_bin_size serial numbers (sn_bin = SN // sn_bin_size) and sorted by SN,
+    so that the row group statistics of the SN column are tight. Reading one
+    test only touches its directory, reading a few boards only the files of
+    their SN ranges and, inside those, only the matching row groups.
+    """
+
+    def __init__(self,
+                 root: str | Path = "output/dataset",
+                 sn_bin_size: int = 100,
+                 compression: str = "zstd",
+                 row_group_size: int = 16384) -> None:
+        self.root = Path(root)
+        self.index_file = self.root / "board_index.parquet"
+        self.sn_bin_size = sn_bin_size
+        self.compression = compression
+        self.row_group_size = row_group_size
+
+
+    def tests(self) -> list[str]:
+        if not self.root.exists():
+            return []
+        return sorted(d.name for d in self.root.iterdir() if d.is_dir())
+
+
+    def write_test(self,
+                   test: str,
+                   data: pd.DataFrame) -> pd.DataFrame:
+        """
+        Replaces the stored frame of the test, data is indexed by SN.
+        Returns the location of the rows of every SN (file, offset and length),
+        see write_board_index
+        """
+        return self.write_test_chunks(test, [data])
+
+
+    def write_test_chunks(self,
+                          test: str,
+                          chunks) -> pd.DataFrame:
+        """
+        Replaces the stored frame of the test by the concatenation of chunks
+        (an iterable of frames indexed by SN), e.g. one chunk per run directory.
+        Every chunk is written to its own part file in the partitions it
+        touches, so only one chunk is held in memory at a time. The rows of
+        an SN must all be in one chunk. Returns the locations as write_test.
+        """
+        test_dir = self.root / test
+        if test_dir.exists():
+            shutil.rmtree(test_dir)
+        test_dir.mkdir(parents=True)
+        locations = []
+        empty = pd.DataFrame(columns=["SN"])
+        for i, chunk in enumerate(chunks):
+            data = chunk.reset_index().sort_values("SN", kind="stable")
+            if len(data) == 0:
+                empty = data
+                continue
+            sn_bin = (data["SN"] // self.sn_bin_size).to_numpy()
+            # one hive style partition per SN range, sn_bin comes back from the directory name
+            for k, part in data.groupby(sn_bin, sort=True):
+                (test_dir / f"sn_bin={k}").mkdir(exist_ok=True)
+                filename = f"{test}/sn_bin={k}/part-{i:05d}.parquet"
+                pq.write_table(pa.Table.from_pandas(part, preserve_index=False),
+                               self.root / filename,
+                               compression=self.compression,
+                               write_statistics=True,
+                               row_group_size=self.row_group_size)
+                # the rows of every SN are contiguous in the sorted partition
+                sns, offsets, lengths = np.unique(part["SN"].to_numpy(), return_index=True, return_counts=True)
+                locations.append(pd.DataFrame({"SN": sns, "file": filename, "offset": offsets, "length": lengths}))
+        if len(locations) == 0:
+            # keep the schema of tests without data, there is no partition to write to
+            empty = empty.astype({"SN": "int64"}).assign(sn_bin=pd.Series(dtype="int64"))
+            pq.write_table(pa.Table.from_pandas(empty, preserve_index=False), test_dir / "empty.parquet")
+            return pd.DataFrame(columns=["SN", "file", "offset", "length"])
+        return pd.concat(locations, ignore_index=True)
+
+
+    def read_test(self,
+                  test: str,
+                  sns: list[int] | None = None,
+                  columns: list[str] | None = None) -> pd.DataFrame:
+        """
+        Reads the frame of the test indexed by SN, only the rows of the given
+        SNs and only the given columns if requested
+        """
+        test_dir = self.root / test
+        if not test_dir.exists():
+            raise FileNotFoundError(f"Test {test} not found in {self.root}")
+        filters = None
+        if sns is not None:
+            sns = [int(sn) for sn in sns]
+            bins = sorted({sn // self.sn_bin_size for sn in sns})
+            # the sn_bin filter prunes the directories, the SN filter the row groups
+            filters = [("sn_bin", "in", bins), ("SN", "in", sns)]
+        if columns is not None:
+            columns = ["SN", *[col for col in columns if col != "SN"]]
+        data = pd.read_parquet(test_dir, columns=columns, filters=filters, partitioning="hive")
+        data = data.drop(columns=["sn_bin"], errors="ignore")
+        return data.set_index("SN")
+
+
+    def write_board_index(self,
+                          locations: dict[str, pd.DataFrame],
+                          sources: dict[str, pd.Series] | None = None) -> pd.DataFrame:
+        """
+        Writes the board index: one row per SN and test with the run directory
+        the rows were taken from, its timestamp and the location of the rows
+        in the dataset (file, offset and length), as returned by write_test.
+        sources maps every test to a Series SN -> run directory. The rows of
+        the tests that are not in locations (not written by this run) are
+        kept from the existing index, as long as the test is still in the
+        dataset.
+        """
+        sources = sources if sources is not None else {}
+        index = []
+        for test, location in locations.items():
+            location = location.assign(test=test)
+            source = sources.get(test)
+            location["run_dir"] = location["SN"].map(source) if source is not None else None
+            index.append(location)
+        index = pd.concat(index, ignore_index=True)
+        index = index[["SN", "test", "run_dir", "file", "offset", "length"]]
+        index = index.astype({"SN": "int64", "run_dir": "string", "offset": "int64", "length": "int64"})
+        # the run directories are named after their timestamp (yyyymmddhhmm)
+        names = index["run_dir"].str.rsplit("/", n=1).str[-1]
+        index.insert(3, "timestamp", pd.to_datetime(names, format="%Y%m%d%H%M", errors="coerce"))
+        if self.index_file.exists():
+            previous = pd.read_parquet(self.index_file)
+            previous = previous[~previous["test"].isin(list(locations)) & previous["test"].isin(self.tests())]
+            index = pd.concat([index, previous.astype(index.dtypes.to_dict())], ignore_index=True)
+        index = index.sort_values(["SN", "test"], kind="stable").reset_index(drop=True)
+        self.root.mkdir(parents=True, exist_ok=True)
+        index.to_parquet(self.index_file, index=False, compression=self.compression, row_group_size=self.row_group_size)
+        return index
+
+
+    def board_info(self,
+                   sn: int) -> pd.DataFrame:
+        # rows of the board index of one SN
+        if not self.index_file.exists():
+            raise FileNotFoundError(f"Board index {self.index_file} not found")
+        return pd.read_parquet(self.index_file, filters=[("SN", "==", int(sn))])
+
+
+    def read_board(self,
+                   sn: int,
+                   tests: list[str] | None = None) -> dict[str, pd.DataFrame]:
+        """
+        Rows of one board in every (or the given) test. With a board index only
+        the row groups holding the rows of the board are read, without one the
+        SN is pushed down as a filter to every test
+        """
+        if not self.index_file.exists():
+            tests = tests if tests is not None else self.tests()
+            return {test: self.read_test(test, sns=[sn]) for test in tests}
+        board = {}
+        for entry in self.board_info(sn).itertuples(index=False):
+            if tests is not None and entry.test not in tests:
+                continue
+            board[entry.test] = self._read_rows(entry.file, entry.offset, entry.length)
+        return board
+
+
+    def _read_rows(self,
+                   filename: str,
+                   offset: int,
+                   length: int) -> pd.DataFrame:
+        # reads rows offset to offset + length of a file from the row groups that contain them
+        parquet_file = pq.ParquetFile(self.root / filename)
+        metadata = parquet_file.metadata
+        starts = np.cumsum([0, *[metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]])
+        first = np.searchsorted(starts, offset, side="right") - 1
+        last = np.searchsorted(starts, offset + length, side="left")
+        table = parquet_file.read_row_groups(list(range(first, last)))
+        data = table.slice(offset - starts[first], length).to_pandas()
+        return data.set_index("SN")
+
+
+def benchmark(frames: dict[str, pd.DataFrame],
+              workdir: str | Path,
+              sn: int | None = None) -> pd.DataFrame:
+    """
+    Times writing and reading the merged frames as the per-test HDF5 tables
+    written before (format='table', data_columns=True) and as a ResultStore.
+    Reports the write time, the time to read everything back, the time to
+    read the rows of one board from all tests and the size on disk.
+    """
+    workdir = Path(workdir)
+    if sn is None:
+        sn = next(int(df.index[0]) for df in frames.values() if len(df) > 0)
+    results = []
+
+    hdf_dir = workdir / "hdf5"
+    hdf_dir.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    for test, df in frames.items():
+        df.to_hdf(hdf_dir / f"{test}.h5", key='data', mode='w', format='table', data_columns=True)
+    write = time.perf_counter() - start
+    start = time.perf_counter()
+    for test in frames:
+        pd.read_hdf(hdf_dir / f"{test}.h5", key='data')
+    read = time.perf_counter() - start
+    start = time.perf_counter()
+    for test in frames:
+        pd.read_hdf(hdf_dir / f"{test}.h5", key='data', where=f"index == {sn}")
+    read_board = time.perf_counter() - start
+    results.append({"format": "hdf5", "write_s": write, "read_s": read, "read_board_s": read_board,
+                    "size_mb": sum(f.stat().st_size for f in hdf_dir.rglob("*.h5")) / 1e6})
+
+    store = ResultStore(workdir / "dataset")
+    start = time.perf_counter()
+    locations = {test: store.write_test(test, df) for test, df in frames.items()}
+    store.write_board_index(locations)
+    write = time.perf_counter() - start
+    start = time.perf_counter()
+    for test in frames:
+        store.read_test(test)
+    read = time.perf_counter() - start
+    start = time.perf_counter()
+    store.read_board(sn, list(frames))
+    read_board = time.perf_counter() - start
+    results.append({"format": "parquet", "write_s": write, "read_s": read, "read_board_s": read_board,
+                    "size_mb": sum(f.stat().st_size for f in store.root.rglob("*.parquet")) / 1e6})
+
+    return pd.DataFrame(results).set_index("format")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the HDF5 and Parquet output of get_tables.py")
+    parser.add_argument("--dataset",
+                        type=str,
+                        default="output/dataset",
+                        help="Dataset written by get_tables.py, the frames to benchmark with")
+    parser.add_argument("--workdir",
+                        type=str,
+                        default="output/benchmark",
+                        help="Directory the benchmark files are written to")
+    args = parser.parse_args()
+    source = ResultStore(args.dataset)
+    frames = {test: source.read_test(test) for test in source.tests() if test != "yield"}
+    print(benchmark(frames, args.workdir).to_string(float_format="{:.3f}".format))
@@ -0,0 +1,160 @@
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+from pathlib import Path
+
+
+def write_tsv(path: Path,
+              data: pd.DataFrame,
+              header: bool = True) -> None:
+    # the header of the calibration files starts with "# "
+    if header:
+        data = data.rename(columns={data.columns[0]: f"# {data.columns[0]}"})
+    data.to_csv(path, sep="\t", header=header, index=False)
+
+
+def channel_grid(n_chips: int,
+                 **axes: int) -> pd.DataFrame:
+    # one row per chip, channel and every value of the extra axes (e.g. tacID=8)
+    shape = [n_chips, 32, *axes.values()]
+    grid = np.indices(shape).reshape(len(shape), -1)
+    data = pd.DataFrame({"portID": 0, "slaveID": 0, "chipID": grid[0], "channelID": grid[1]})
+    for i, axis in enumerate(axes):
+        data[axis] = grid[2 + i]
+    return data
+
+
+def make_run_dir(d: Path,
+                 sns: np.ndarray,
+                 rng: np.random.Generator,
+                 broken_qdc: list[bool]) -> None:
+    """
+    Writes the files of one run: detailed_results.tsv, one serial file per
+    tester (SN_3211_0_03_0_00_<SN>.txt, some with spaces) and the data of
+    every test for len(sns) testers with two chips each
+    """
+    d.mkdir(parents=True, exist_ok=True)
+    (d / "detailed_results.tsv").write_text("result\n")
+    for tester, sn in enumerate(sns):
+        sep = " " if tester % 3 == 0 else "_"
+        (d / f"SN_3211{sep}0{sep}03{sep}0{sep}00{sep}{sn}.txt").write_text(f"{tester}\n")
+    n_testers = len(sns)
+    n_chips = 2 * n_testers
+
+    # per tester tests
+    testers = np.arange(n_testers)
+    write_tsv(d / "tec.tsv", pd.DataFrame({0: testers, 1: rng.normal(1.3, 0.15, n_testers).round(4)}), header=False)
+    write_tsv(d / "current_after_init.tsv", pd.DataFrame({0: testers, 1: rng.normal(0.8, 0.03, n_testers).round(4)}), header=False)
+    write_tsv(d / "current_after_power_up.tsv", pd.DataFrame({0: testers, 1: rng.normal(0.8, 0.03, n_testers).round(4)}), header=False)
+    write_tsv(d / "pt1000.tsv", pd.DataFrame({0: np.repeat(testers, 2), 1: np.tile([0, 1], n_testers),
+                                              2: rng.normal(3, 0.5, 2 * n_testers).round(4)}), header=False)
+
+    # ALDO: Vout is linear in the DAC, with a slope per tester, asic, side and gain
+    grid = np.indices([2, 256, n_testers, 2, 2]).reshape(5, -1)
+    gain, dac, tester, asic, side = grid
+    slopes = np.where(np.arange(2) == 0, 0.0205, 0.0408)[:, None] * (1 + rng.normal(0, 0.02, (2, 4 * n_testers)))
+    slope = slopes[gain, tester * 4 + asic * 2 + side]
+    vout = np.where(gain == 0, 35, 32) + slope * dac + rng.normal(0, 0.02, len(dac))
+    current = np.abs(rng.normal(6e-5, 1e-5, len(dac)))
+    write_tsv(d / "aldo.tsv", pd.DataFrame({0: tester, 1: asic, 2: side, 3: gain, 4: dac,
+                                            5: vout.round(6), 6: current.round(8)}), header=False)
+
+    tdc = channel_grid(n_chips, tacID=8, branch=2)
+    tdc["branch"] += 1
+    n = len(tdc)
+    tdc["t0"] = rng.normal(0, 0.1, n).round(6)
+    tdc["a0"] = rng.normal(60, 10, n).round(6)
+    tdc["a1"] = rng.normal(510, 30, n).round(5)
+    tdc["a2"] = rng.normal(-0.5, 0.5, n).round(6)
+    tdc["sigma"] = rng.normal(0.0066, 0.001, n).round(6)
+    write_tsv(d / "tdc_calibration.tsv", tdc)
+
+    for k, broken in enumerate(broken_qdc):
+        qdc = channel_grid(n_chips, tacID=4)
+        n = len(qdc)
+        qdc["trim"] = rng.integers(2, 44, n)
+        qdc["p0"] = rng.normal(60, 30, n).round(5)
+        qdc["p1"] = rng.normal(1, 4, n).round(5)
+        for j in range(2, 10):
+            qdc[f"p{j}"] = rng.normal(0, 0.1, n).round(6)
+        qdc["sigma"] = rng.normal(10, 3, n).round(4)
+        path = d / f"qdc_calibration{k}.tsv"
+        write_tsv(path, qdc)
+        if broken:
+            # the header of some files misses the p9 column, the rows still have it
+            lines = path.read_text().split("\n", 1)
+            path.write_text(lines[0].replace("\tp9", "") + "\n" + lines[1])
+
+    for k in range(4):
+        disc = channel_grid(n_chips)
+        n = len(disc)
+        for col in ["noise_T1", "noise_T2", "noise_E"]:
+            disc[col] = np.abs(rng.normal(0.2, 0.2, n)).round(4)
+        for col in ["zero_T1", "zero_T2", "zero_E"]:
+            disc[col] = rng.normal(10, 6, n).round(3)
+        write_tsv(d / f"disc_calibration{k}.tsv", disc)
+
+    for filename in ["fetp_tres_scan.tsv", "extp_tres_scan.tsv"]:
+        pulse = channel_grid(n_chips)[["chipID", "channelID"]]
+        n = len(pulse)
+        pulse["amplitude"] = rng.normal(100, 10, n).round(3)
+        pulse["time_resolution"] = rng.normal(50, 5, n).round(3)
+        pulse["energy_mean"] = rng.normal(200, 10, n).round(3)
+        pulse["energy_rms"] = rng.normal(3, 1, n).round(3)
+        write_tsv(d / filename, pulse, header=False)
+
+
+def make_campaign(base_dir: str | Path,
+                  n_dirs: int = 6,
+                  testers: int = 8,
+                  sn_pool: int = 30,
+                  broken_qdc_fraction: float = 0.5,
+                  missing_file_dirs: int = 1,
+                  start: str = "202407011000",
+                  seed: int = 1) -> list[Path]:
+    """
+    Writes a fake campaign of n_dirs run directories to base_dir, one hour
+    apart from start (yyyymmddhhmm). Every run tests `testers` boards drawn
+    from sn_pool serial numbers, so that boards are retested. A fraction of
+    the QDC files has the broken header and pt1000.tsv is missing in the
+    last missing_file_dirs directories. Returns the run directories.
+    """
+    rng = np.random.default_rng(seed)
+    base_dir = Path(base_dir)
+    first = datetime.strptime(start, "%Y%m%d%H%M")
+    dirs = []
+    for i in range(n_dirs):
+        d = base_dir / (first + timedelta(hours=i)).strftime("%Y%m%d%H%M")
+        sns = rng.choice(np.arange(100, 100 + sn_pool), testers, replace=False)
+        make_run_dir(d, sns, rng, list(rng.random(8) < broken_qdc_fraction))
+        dirs.append(d)
+    for d in dirs[len(dirs) - missing_file_dirs:]:
+        (d / "pt1000.tsv").unlink()
+    return dirs
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Write a synthetic campaign of run directories")
+    parser.add_argument("base_dir",
+                        type=str,
+                        help="Directory the run directories are written to")
+    parser.add_argument("--n_dirs",
+                        type=int,
+                        default=6,
+                        help="Number of run directories")
+    parser.add_argument("--testers",
+                        type=int,
+                        default=8,
+                        help="Number of boards tested per run")
+    parser.add_argument("--sn_pool",
+                        type=int,
+                        default=30,
+                        help="Number of distinct serial numbers, fewer than n_dirs * testers means retests")
+    parser.add_argument("--seed",
+                        type=int,
+                        default=1,
+                        help="Seed of the random numbers")
+    args = parser.parse_args()
+    dirs = make_campaign(args.base_dir, args.n_dirs, args.testers, args.sn_pool, seed=args.seed)
+    print(f"Wrote {len(dirs)} run directories to {args.base_dir}")
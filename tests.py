@@ -3,9 +3,67 @@ from pathlib import Path
 import matplotlib.pyplot as plt
 from hist import Hist, Stack
 import numpy as np
+import threading
+from collections import Counter
+
+from cuts import CutTable, get_default_cut_table
+import profiling
+
+# number of times each data file was parsed (in this process), see report_parse_counts
+parse_counts = Counter()
+_parse_counts_lock = threading.Lock()
+
+
+def count_parse(datafile: str | Path) -> None:
+    with _parse_counts_lock:
+        parse_counts[str(datafile)] += 1
+
+
+def report_parse_counts() -> None:
+    reparsed = {f: n for f, n in parse_counts.items() if n > 1}
+    print(f"Parsed {len(parse_counts)} files {sum(parse_counts.values())} times, "
+          f"{len(reparsed)} of them more than once")
+    for f, n in sorted(reparsed.items()):
+        print(f"  {f}: {n}")
+
+
+class SerialLookup:
+    """
+    Dense array indexed by tester ID holding the serial number of the board in
+    that tester slot, maps a whole column of tester IDs in one operation
+    """
+    def __init__(self,
+                 tester_to_serial: dict) -> None:
+        self.tester_to_serial = tester_to_serial
+        size = max(tester_to_serial) + 1 if len(tester_to_serial) > 0 else 0
+        self.serials = np.zeros(size, dtype=np.int64)
+        self.known = np.zeros(size, dtype=bool)
+        for tester, sn in tester_to_serial.items():
+            self.serials[tester] = sn
+            self.known[tester] = True
+
+
+    def map(self,
+            testers: pd.Series | np.ndarray) -> np.ndarray:
+        testers = np.asarray(testers)
+        in_range = (testers >= 0) & (testers < len(self.serials))
+        # raise an error if a tester_ID is not in the dictionary
+        if not in_range.all() or not self.known[testers].all():
+            print(f"Tester ID's in the data: {np.unique(testers)}")
+            print(f"Tester iD's in the dictionary: {sorted(self.tester_to_serial.keys())}")
+            raise ValueError("Some Tester ID's present in data couldn't be assigned a serial file")
+        return self.serials[testers]
 
 
 class Test:
+    # source column (name or position) -> dtype of the columns read from the data file.
+    # Columns a cut is applied to stay float64, so that the cuts give the same result
+    dtypes: dict | None = None
+    # source column -> column name in the frame returned by get_data (files without header)
+    rename: dict = {}
+    # values of id_col per tester, the chips are numbered two per tester
+    ids_per_tester: int = 2
+
     def __init__(self,
                  name: str = "",
                  filename: str = "",
@@ -13,43 +71,129 @@ class Test:
                  header: int | None = 0,
                  index_col: int | None = None,
                  id_col: str = "chipID",
-                 tester_to_serial: dict | None = None) -> None:
+                 tester_to_serial: dict | None = None,
+                 sn_lookup: SerialLookup | None = None,
+                 cut_table: CutTable | None = None,
+                 check_exists: bool = True,
+                 engine: str = "c",
+                 label: str | None = None) -> None:
         self.name = name
+        # name of the test in the profiling records, the test_map key of get_tables.py
+        self.label = label if label is not None else name
+        self.engine = engine
         self.header = header
         self.index_col = index_col
         self.id_col = id_col
         self.tester_to_serial = tester_to_serial
+        # built from tester_to_serial if it isn't shared by the TestResult
+        if sn_lookup is None and tester_to_serial is not None:
+            sn_lookup = SerialLookup(tester_to_serial)
+        self.sn_lookup = sn_lookup
+        self.cut_table = cut_table if cut_table is not None else get_default_cut_table()
         self.filename = filename
         self.datafile = Path(test_result_dir) / self.filename
-        if not self.datafile.exists():
+        if check_exists and not self.datafile.exists():
             raise FileNotFoundError(f"File {self.datafile} not found")
 
 
-    def read_data(self):
-        if self.name == "qdc_calibration":
-            cols = pd.read_csv(self.datafile, sep="\t", header=self.header, index_col=self.index_col).columns
-            if not ("p9" in cols):
-                print("fixing QDC data")
-                cols = [*[c.replace("# ", "") for c in cols[:-1]], 'p9', 'sigma']
-                return pd.read_csv(self.datafile, sep="\t", header=None, skiprows=1, names=cols)
+    def read_csv(self,
+                 columns: list | None = None,
+                 **kwargs) -> pd.DataFrame:
+        # only read the declared columns (or the given subset of them) with their compact dtypes
+        options = {"engine": self.engine, **kwargs}
+        schema = self.dtypes
+        if schema is not None and columns is not None:
+            schema = {col: schema[col] for col in columns}
+        if schema is not None:
+            options["usecols"] = list(schema)
+            options["dtype"] = schema
+            if self.engine == "pyarrow" and "names" in kwargs:
+                # the pyarrow engine can't combine names and usecols
+                del options["usecols"]
+        with profiling.stage("read_csv", test=self.label, path=self.datafile) as record:
+            data = pd.read_csv(self.datafile, **options)
+            record["rows"] = len(data)
+        if schema is not None and self.engine == "pyarrow":
+            if "names" in kwargs:
+                data = data[list(schema)]
+            elif kwargs.get("header") is None:
+                # the pyarrow engine numbers the selected columns of a file without header from 0
+                data.columns = sorted(schema)
+        return data
+
 
+    def read_data(self,
+                  columns: list | None = None):
+        count_parse(self.datafile)
         if self.datafile.suffix == ".csv":
-            return pd.read_csv(self.datafile, header=self.header, index_col=self.index_col)
+            return self.read_csv(columns, header=self.header, index_col=self.index_col)
         elif self.datafile.suffix == ".tsv":
-            return pd.read_csv(self.datafile, sep="\t", header=self.header, index_col=self.index_col)
+            return self.read_csv(columns, sep="\t", header=self.header, index_col=self.index_col)
         else:
             raise ValueError("File format not supported")
 
     
-    def get_passing_info(self):
-        passing_series = self.get_data().groupby("SN")["test_pass"].all()
+    def apply_cuts(self,
+                   data: pd.DataFrame) -> pd.DataFrame:
+        # adds fail_<cut> for every cut of this test in the cut table and test_pass
+        return self.cut_table.apply(self.name, data)
+
+
+    def get_pass_data(self) -> pd.DataFrame:
+        """
+        Reduced get_data for yield-only runs: reads only the ID column and the
+        columns the cuts of this test refer to, maps the SN and applies the cuts
+        """
+        # column name after renaming -> source column
+        source = {self.rename.get(col, col): col for col in self.dtypes}
+        needed = [source[col] for col in self.cut_table.columns_for(self.name) if col in source]
+        columns = [self.id_col, *[col for col in needed if col != self.id_col]]
+        data = self.read_data(columns)
+        # add SN, raises an error if a tester_ID is not in the dictionary
+        data["SN"] = self.sn_lookup.map(data[self.id_col] // self.ids_per_tester)
+        return self.apply_cuts(data.rename(columns=self.rename))
+
+
+    def reads_pass_data(self,
+                        pass_only: bool) -> bool:
+        # get_passing_info only reads the columns of the cuts for tests with cuts and declared columns
+        return pass_only and self.dtypes is not None and len(self.cut_table.cuts_for(self.name)) > 0
+
+
+    @staticmethod
+    def passing_frame(data: pd.DataFrame) -> pd.DataFrame:
+        # SN and test_pass of all rows of the board, from the frame of get_data
+        passing_series = data.groupby("SN")["test_pass"].all()
         # create dataframe with "SN"
         df = passing_series.to_frame().reset_index()
         df["SN"] = df["SN"].astype(int)
-        return df 
+        return df
+
+
+    def get_passing_info(self,
+                         pass_only: bool = False):
+        """
+        SN -> test_pass of all rows of the board. With pass_only only the columns
+        the cuts need are read (see get_pass_data) and the number of failed rows
+        of every cut is added as fail_<cut>. Tests without cuts or declared
+        columns always use the full get_data.
+        """
+        if not self.reads_pass_data(pass_only):
+            return self.passing_frame(self.get_data())
+        data = self.get_pass_data()
+        groupby = data.groupby("SN")
+        df = groupby[[col for col in data.columns if col.startswith("fail_")]].sum()
+        df.insert(0, "test_pass", groupby["test_pass"].all())
+        df = df.reset_index()
+        df["SN"] = df["SN"].astype(int)
+        return df
 
 
 class Pt_1000(Test):
+    dtypes = {0: "int16", 1: "int16", 2: "float64"}
+    rename = {0: "tester_ID", 1: "chipID", 2: "resistance"}
+    ids_per_tester = 1
+
     def __init__(self,
                  name: str = "Pt_1000",
                  filename: str = "pt1000.tsv",
@@ -65,20 +209,18 @@ class Pt_1000(Test):
     
     def get_data(self) -> pd.DataFrame:
         data = self.read_data()
-        rename = {0: "tester_ID", 1: "chipID", 2: "resistance"}
-        data = data.rename(columns=rename)
-        # raise an error if the tester_ID is not in the dictionary
-        if not all(data["tester_ID"].isin(self.tester_to_serial)):
-            print(f"Tester ID's in the data: {data['tester_ID'].unique()}")
-            print(f"Tester iD's in the dictionary: {sorted(self.tester_to_serial.keys())}")
-            raise ValueError("Some Tester ID's present in data couldn't be assigned a serial file")
-        data['SN'] = data['tester_ID'].map(self.tester_to_serial)
+        data = data.rename(columns=self.rename)
+        # raises an error if a tester_ID is not in the dictionary
+        data['SN'] = self.sn_lookup.map(data['tester_ID'])
         # resistance needs to be 2.25 < r < 3.75
-        data["test_pass"] = data["resistance"].apply(lambda x: 2.25 < x < 3.75)
-        return data
+        return self.apply_cuts(data)
 
 
 class Tec(Test):
+    dtypes = {0: "int16", 1: "float64"}
+    rename = {0: "tester_ID", 1: "resistance"}
+    ids_per_tester = 1
+
     def __init__(self,
                  name: str = "Tec",
                  filename: str = "tec.tsv",
@@ -94,20 +236,18 @@ class Tec(Test):
         
     def get_data(self) -> pd.DataFrame:
         data = self.read_data()
-        rename = {0: "tester_ID", 1: "resistance"}
-        data = data.rename(columns=rename)
-        # raise an error if the tester_ID is not in the dictionary
-        if not all(data["tester_ID"].isin(self.tester_to_serial)):
-            print(f"Tester ID's in the data: {data['tester_ID'].unique()}")
-            print(f"Tester iD's in the dictionary: {sorted(self.tester_to_serial.keys())}")
-            raise ValueError("Some Tester ID's present in data couldn't be assigned a serial file")
-        data["SN"] = data["tester_ID"].map(self.tester_to_serial)
+        data = data.rename(columns=self.rename)
+        # raises an error if a tester_ID is not in the dictionary
+        data["SN"] = self.sn_lookup.map(data["tester_ID"])
         # resistance needs to be 1.1 < r < 1.5 
-        data["test_pass"] = data["resistance"].apply(lambda x: 1.1 < x < 1.5)
-        return data
+        return self.apply_cuts(data)
 
 
 class CaPup(Test):
+    dtypes = {0: "int16", 1: "float64"}
+    rename = {0: "tester_ID", 1: "current"}
+    ids_per_tester = 1
+
     def __init__(self,
                  name: str = "CaPup",
                  filename: str = "current_after_power_up.tsv",
@@ -123,19 +263,17 @@ class CaPup(Test):
         
     def get_data(self) -> pd.DataFrame:
         data = self.read_data()
-        rename = {0: "tester_ID", 1: "current"}
-        data = data.rename(columns=rename)
-        # raise an error if the tester_ID is not in the dictionary
-        if not all(data["tester_ID"].isin(self.tester_to_serial)):
-            print(f"Tester ID's in the data: {data['tester_ID'].unique()}")
-            print(f"Tester iD's in the dictionary: {sorted(self.tester_to_serial.keys())}")
-            raise ValueError("Some Tester ID's present in data couldn't be assigned a serial file")
-        data["SN"] = data["tester_ID"].map(self.tester_to_serial)
+        data = data.rename(columns=self.rename)
+        # raises an error if a tester_ID is not in the dictionary
+        data["SN"] = self.sn_lookup.map(data["tester_ID"])
         # current limits : 0.75 < c < 0.85
-        data["test_pass"] = data["current"].map(lambda x: 0.75 < x < 0.85)
-        return data
+        return self.apply_cuts(data)
     
 class CaInit(Test):
+    dtypes = {0: "int16", 1: "float64"}
+    rename = {0: "tester_ID", 1: "current"}
+    ids_per_tester = 1
+
     def __init__(self,
                  name: str = "CaInit",
                  filename: str = "current_after_init.tsv",
@@ -151,20 +289,21 @@ class CaInit(Test):
     
     def get_data(self) -> pd.DataFrame:
         data = self.read_data()
-        rename = {0: "tester_ID", 1: "current"}
-        data = data.rename(columns=rename)
-        # raise an error if the tester_ID is not in the dictionary
-        if not all(data["tester_ID"].isin(self.tester_to_serial)):
-            print(f"Tester ID's in the data: {data['tester_ID'].unique()}")
-            print(f"Tester iD's in the dictionary: {sorted(self.tester_to_serial.keys())}")
-            raise ValueError("Some Tester ID's present in data couldn't be assigned a serial file")
-        data["SN"] = data["tester_ID"].map(self.tester_to_serial)
+        data = data.rename(columns=self.rename)
+        # raises an error if a tester_ID is not in the dictionary
+        data["SN"] = self.sn_lookup.map(data["tester_ID"])
         # current limits : 0.75 < c < 0.85
-        data["test_pass"] = data["current"].map(lambda x: 0.75 < x < 0.85)
-        return data
+        return self.apply_cuts(data)
 
 
 class Aldo(Test):
+    # tester_ID, asic_id, side, gain, DAC, Vout, current
+    dtypes = {0: "int16", 1: "int16", 2: "int16", 3: "int16",
+              4: "int16", 5: "float64", 6: "float32"}
+    rename = {0: "tester_ID", 1: "asic_id", 2: "side", 3: "gain",
+              4: "DAC", 5: "Vout", 6: "current"}
+    ids_per_tester = 1
+
     def __init__(self,
                  name: str = "aldo",
                  filename: str = "aldo.tsv",
@@ -179,57 +318,55 @@ class Aldo(Test):
                          id_col=id_col,
                          **kwargs)
 
+    def fit(self,
+            data: pd.DataFrame) -> pd.DataFrame:
+        """
+        Linear fit of Vout vs DAC of every tester_ID, asic_id, side and gain,
+        returns one row per group with slope, b, max_inl and the cuts applied
+        """
+        with profiling.stage("aldo_fit", test=self.label, directory=self.datafile.parent) as record:
+            reduced_df = self._fit(data)
+            record["rows"] = len(data)
+        return reduced_df
+
+
+    def _fit(self,
+             data: pd.DataFrame) -> pd.DataFrame:
+        # Ensure DAC < 250
+        fit_data = data[data.DAC < 250]
+        groupby = fit_data.groupby(['tester_ID', 'asic_id', 'side', 'gain'])
+        group = groupby.ngroup().to_numpy()
+        x = fit_data["DAC"].to_numpy(dtype=float)
+        y = fit_data["Vout"].to_numpy(dtype=float)
+
+        # linear least squares fit of all groups at once from the grouped sums
+        n = np.bincount(group)
+        sum_x = np.bincount(group, weights=x)
+        sum_y = np.bincount(group, weights=y)
+        sum_xy = np.bincount(group, weights=x * y)
+        sum_xx = np.bincount(group, weights=x * x)
+        slope = (n * sum_xy - sum_x * sum_y) / (n * sum_xx - sum_x ** 2)
+        b = (sum_y - slope * sum_x) / n
+        error = np.abs(y - (slope[group] * x + b[group]))
+        max_inl = pd.Series(error).groupby(group).max().to_numpy() / slope
+
+        reduced_df = groupby.size().index.to_frame(index=False)
+        reduced_df["slope"] = slope
+        reduced_df["b"] = b
+        reduced_df["max_inl"] = max_inl
+        # Assuming there's only one unique SN per group
+        reduced_df["SN"] = groupby["SN"].first().to_numpy()
+
+        # slope, b and max_inl limits depend on the gain
+        return self.apply_cuts(reduced_df)
+
+
     def get_data(self):
         data = self.read_data()
-        rename = {0: "tester_ID", 1: "asic_id", 2: "side", 3: "gain",
-                  4: "DAC", 5: "Vout", 6: "current"}
-        data = data.rename(columns=rename)
-        # raise an error if the tester_ID is not in the dictionary
-        if not all(data["tester_ID"].isin(self.tester_to_serial)):
-            print(f"Tester ID's in the data: {data['tester_ID'].unique()}")
-            print(f"Tester iD's in the dictionary: {sorted(self.tester_to_serial.keys())}")
-            raise ValueError("Some Tester ID's present in data couldn't be assigned a serial file")
-        data["SN"] = data["tester_ID"].apply(lambda x: int(self.tester_to_serial[x]))
-
-        def process_group(group):
-            # Ensure DAC < 250
-            fit_data = group[group.DAC < 250]
-            slope, b = np.polyfit(fit_data.DAC, fit_data.Vout, 1)
-            error = fit_data.Vout - (slope * fit_data.DAC + b)
-            max_inl = max(abs(error)) / slope
-            # Assuming there's only one unique SN per group
-            SN = int(fit_data.SN.unique()[0])
-            return pd.Series([slope, b, max_inl, SN], index=['slope', 'b', 'max_inl', 'SN'])
-
-        groupby = data.groupby(['tester_ID', 'asic_id', 'side', 'gain'])
-        reduced_df = groupby.apply(process_group).reset_index()
-
-        gain = (220 + 5.11) / 5.11
-        aldo_limits = {0: {"slope": (gain * 0.000445, gain * 0.000485),
-                           "b": (34, gain * 0.86),
-                           "inl": (0, 5)},
-                       1: {"slope": (gain * 0.00089, gain * 0.00096),
-                           "b": (31, gain * 0.77),
-                           "inl": (0, 8)}}
-
-        def apply_conditions(group, aldo_limits):
-            # Extract the limits for the current "gain" value from the group name
-            limits = aldo_limits[group.name]
-            # Apply conditions using vectorized operations
-            conditions_met = (
-                (group["slope"] > limits["slope"][0]) &
-                (group["slope"] < limits["slope"][1]) &
-                (group["b"] > limits["b"][0]) &
-                (group["b"] < limits["b"][1]) &
-                (group["max_inl"] > limits["inl"][0]) &
-                (group["max_inl"] < limits["inl"][1])
-            )
-            return conditions_met
-
-        # Group the DataFrame by "gain" and apply the conditions
-        result = reduced_df.groupby("gain")[["slope", "b", "max_inl"]].apply(apply_conditions, aldo_limits=aldo_limits)
-
-        reduced_df["test_pass"] = result.reset_index(level=0, drop=True)
+        data = data.rename(columns=self.rename)
+        # raises an error if a tester_ID is not in the dictionary
+        data["SN"] = self.sn_lookup.map(data["tester_ID"])
+        reduced_df = self.fit(data)
 
         # Merge the reduced DataFrame with the original data
         merged_df = pd.merge(data, reduced_df, on=['tester_ID', 'asic_id', 'side', 'gain', 'SN'], how='left')
@@ -237,6 +374,14 @@ class Aldo(Test):
         return merged_df
 
 
+    def get_pass_data(self):
+        # the cuts are on the fit results, the fit needs every column but the current
+        data = self.read_data([0, 1, 2, 3, 4, 5])
+        data = data.rename(columns=self.rename)
+        data["SN"] = self.sn_lookup.map(data["tester_ID"])
+        return self.fit(data)
+
+
 class DiscCalibration(Test):
     """
     Disc calibration
@@ -254,8 +399,15 @@ class DiscCalibration(Test):
             2:[33,17,5], # same
             3:[25, 13, 4] # same
     }
+    (the cuts of every disc range are defined in cuts.csv)
     
     """
+    dtypes = {"chipID": "int16",
+              "channelID": "int16",
+              **{f"{prefix}_{suffix}": "float64"
+                 for prefix in ["noise", "zero"]
+                 for suffix in ["T1", "T2", "E"]}}
+
     def __init__(self,
                     name: str = "disc_calibration",
                     filename: str = "disc_calibration.tsv",
@@ -271,19 +423,14 @@ class DiscCalibration(Test):
 
     def get_data(self):
         data = self.read_data()
-        # raise an error if the tester_ID is not in the dictionary
-        unique_testers = (data[self.id_col] // 2).unique()
-        if any([tester not in self.tester_to_serial for tester in unique_testers]):
-            print(f"Tester ID's in the data: {unique_testers}")
-            print(f"Tester iD's in the dictionary: {list(sorted(self.tester_to_serial.keys()))}")
-            raise ValueError("Some Tester ID's present in data couldn't be assigned a serial file")
-        # add SN 
-        data["SN"] = data[self.id_col].apply(lambda x: self.tester_to_serial[x // 2])
+        # add SN, raises an error if a tester_ID is not in the dictionary
+        data["SN"] = self.sn_lookup.map(data[self.id_col] // 2)
         keeps = ["SN", self.id_col, "channelID",
                  *[f"{prefix}_{suffix}"
                    for prefix in ["noise", "zero"]
                    for suffix in ["T1", "T2", "E"]]]
-        return data[keeps]
+        # apply the conditions of the disc range
+        return self.apply_cuts(data[keeps])
 
 
 class TDCCalibration(Test):
@@ -294,8 +441,12 @@ class TDCCalibration(Test):
     sigma < 62.5 / 6250
     a1 > 440
     1.5*a1 + a0 < 1000
+    (the cuts are defined in cuts.csv)
     
     """
+    dtypes = {"chipID": "int16", "channelID": "int16", "tacID": "int16", "branch": "int16",
+              "t0": "float32", "a0": "float64", "a1": "float64", "a2": "float32", "sigma": "float64"}
+
     def __init__(self,
                  name: str = "TDCCalibration",
                  filename: str = "tdc_calibration.tsv",
@@ -310,24 +461,18 @@ class TDCCalibration(Test):
         
     def get_data(self):
         data = self.read_data()
-        # raise an error if the tester_ID is not in the dictionary
-        unique_testers = (data[self.id_col] // 2).unique()
-        if any([tester not in self.tester_to_serial for tester in unique_testers]):
-            print(f"Tester ID's in the data: {unique_testers}")
-            print(f"Tester iD's in the dictionary: {list(sorted(self.tester_to_serial.keys()))}")
-            raise ValueError("Some Tester ID's present in data couldn't be assigned a serial file")
-        # add asic_id
-        data["SN"] = data[self.id_col].apply(lambda x: self.tester_to_serial[x // 2])
+        # add SN, raises an error if a tester_ID is not in the dictionary
+        data["SN"] = self.sn_lookup.map(data[self.id_col] // 2)
         keeps = ["SN", self.id_col, "channelID", "tacID",
                  "branch", "t0", *[f"a{i}" for i in range(0,3)], "sigma"]
-        data = data[keeps]
         # apply conditions
-        conditions = (data["sigma"] < 62.5 / 6250) & (data["a1"] > 440) & (1.5*data["a1"] + data["a0"] < 1000)
-        data["test_pass"] = conditions
-        return data
+        return self.apply_cuts(data[keeps])
 
         
 class TestPulse(Test):
+    # chipID, channelID, amplitude, time_resolution, energy_mean, energy_rms
+    dtypes = {0: "int16", 1: "int16", 2: "float32", 3: "float32", 4: "float32", 5: "float32"}
+
     def __init__(self,
                  name: str = "test_pulse",
                  filename: str = "fetp_tres_scan.tsv",
@@ -344,14 +489,8 @@ class TestPulse(Test):
 
     def get_data(self):
         data = self.read_data()
-        # raise an error if the tester_ID is not in the dictionary
-        unique_testers = (data[self.id_col] // 2).unique()
-        if any([tester not in self.tester_to_serial for tester in unique_testers]):
-            print(f"Tester ID's in the data: {unique_testers}")
-            print(f"Tester iD's in the dictionary: {list(sorted(self.tester_to_serial.keys()))}")
-            raise ValueError("Some Tester ID's present in data couldn't be assigned a serial file")
-        # add SN
-        data["SN"] = data[self.id_col].apply(lambda x: self.tester_to_serial[x // 2])
+        # add SN, raises an error if a tester_ID is not in the dictionary
+        data["SN"] = self.sn_lookup.map(data[self.id_col] // 2)
         keeps = ["SN", self.id_col, 1, 2, 3, 4, 5] 
         # rename 
         rename = {0: "chipID",
@@ -378,7 +517,11 @@ class QDCCalibration(Test):
 
     p0 < 100
     -2 < p1 < 15
+    (the cuts are defined in cuts.csv)
     """
+    dtypes = {"chipID": "int16", "trim": "int16", "p0": "float64", "p1": "float64",
+              "p2": "float32", "p3": "float32", "sigma": "float32"}
+
     def __init__(self,
                  name="qdc_calibration",
                  filename: str="qdc_calibration.tsv",
@@ -391,28 +534,27 @@ class QDCCalibration(Test):
                          header=header,
                          index_col=index_col,
                          **kwargs)
+
+    def read_data(self,
+                  columns: list | None = None):
+        # some files have a header that misses the p9 column, the rows still have it.
+        # Sniff the first line, so that the file is parsed only once in either case
+        with open(self.datafile, "r") as file:
+            cols = file.readline().rstrip("\n").split("\t")
+        if "p9" in cols:
+            return super().read_data(columns)
+        print("Fixing QDC data")
+        count_parse(self.datafile)
+        cols = [*[c.replace("# ", "") for c in cols[:-1]], 'p9', 'sigma']
+        return self.read_csv(columns, sep="\t", header=None, skiprows=1, names=cols)
         
     def get_data(self):
         data = self.read_data()
-
-        if "p9" not in data.columns:
-            print("Fixing QDC data")
-            cols = [*[c.replace("# ", "") for c in data.columns[:-1]], 'p9', 'sigma']
-            data = pd.read_csv(self.datafile, sep="\t", header=None, skiprows=1, names=cols)
-        # raise an error if the tester_ID is not in the dictionary
-        unique_testers = (data[self.id_col] // 2).unique()
-        if any([tester not in self.tester_to_serial for tester in unique_testers]):
-            print(f"Tester ID's in the data: {unique_testers}")
-            print(f"Tester iD's in the dictionary: {list(sorted(self.tester_to_serial.keys()))}")
-            raise ValueError("Some Tester ID's present in data couldn't be assigned a serial file")
-        # add SN
-        data["SN"] = data[self.id_col].apply(lambda x: self.tester_to_serial[x // 2])
+        # add SN, raises an error if a tester_ID is not in the dictionary
+        data["SN"] = self.sn_lookup.map(data[self.id_col] // 2)
         keeps = ["SN", self.id_col, "trim",*[f"p{i}" for i in range(0, 4)], "sigma"]
-        data = data[keeps]
         # apply conditions
-        conditions = (data["p0"] < 100) & (data["p1"] > -2) & (data["p1"] < 15)
-        data["test_pass"] = conditions
-        return data
+        return self.apply_cuts(data[keeps])
     
 # qdc calibration has 8 settings
 
@@ -490,18 +632,6 @@ class DiscCalibration_0(DiscCalibration):
                 filename: str = "disc_calibration0.tsv",
                 **kwargs):
         super().__init__(name,filename, **kwargs)
-    
-    def get_data(self):
-        data = super().get_data()
-        # apply conditions
-        conditions = ((data["noise_T1"] < 2) &
-                     (data["noise_T2"] < 1) &
-                     (data["noise_E"] < 0.6) &
-                     ((0 < data["zero_T1"]) & ( data["zero_T1"] < 100)) &
-                     ((0 < data["zero_T2"]) & ( data["zero_T2"] < 50)) &
-                     (data["zero_E"] < 16))
-        data["test_pass"] = conditions
-        return data
 
 
 class DiscCalibration_1(DiscCalibration):
@@ -511,18 +641,6 @@ class DiscCalibration_1(DiscCalibration):
                 filename: str = "disc_calibration1.tsv",
                 **kwargs):
         super().__init__(name,filename, **kwargs)
-
-    def get_data(self):
-        data = super().get_data()
-        # apply conditions
-        conditions = ((data["noise_T1"] < 1) &
-                     (data["noise_T2"] < 0.5) &
-                     (data["noise_E"] < 0.3) &
-                     ((0 < data["zero_T1"]) & ( data["zero_T1"] < 50)) &
-                     ((0 < data["zero_T2"]) & ( data["zero_T2"] < 25)) &
-                     (data["zero_E"] < 8))
-        data["test_pass"] = conditions
-        return data
         
 class DiscCalibration_2(DiscCalibration):
     """Disc calibration (Attenuation = 2)"""
@@ -532,18 +650,6 @@ class DiscCalibration_2(DiscCalibration):
                 **kwargs):
         super().__init__(name,filename, **kwargs)
 
-    def get_data(self):
-        data = super().get_data()
-        # apply conditions
-        conditions = ((data["noise_T1"] < 0.67) &
-                     (data["noise_T2"] < 0.33) &
-                     (data["noise_E"] < 0.3) &
-                     (( 0 < data["zero_T1"] ) & ( data["zero_T1"] < 33 )) &
-                     (( 0 < data["zero_T2"] ) & ( data["zero_T2"] < 17 )) &
-                     (data["zero_E"] < 5))
-        data["test_pass"] = conditions
-        return data
-
 class DiscCalibration_3(DiscCalibration):
     """Disc calibration (Attenuation = 3)"""
     def __init__(self,
@@ -551,18 +657,6 @@ class DiscCalibration_3(DiscCalibration):
                 filename: str = "disc_calibration3.tsv",
                 **kwargs):
         super().__init__(name,filename, **kwargs)
-    
-    def get_data(self):
-        data = super().get_data()
-        # apply conditions
-        conditions = ((data["noise_T1"] < 0.5) &
-                        (data["noise_T2"] < 0.25) &
-                        (data["noise_E"] < 0.3) &
-                        (( 0 < data["zero_T1"] ) & ( data["zero_T1"] < 25 )) &
-                        (( 0 < data["zero_T2"] ) & ( data["zero_T2"] < 13 )) &
-                        (data["zero_E"] < 4))
-        data["test_pass"] = conditions
-        return data
         
         
 #class MergedTest():
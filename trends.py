@@ -0,0 +1,198 @@
+import json
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from discovery import RunDiscovery
+from history import RetestHistory
+from store import write_atomically
+
+
+class YieldTrends:
+    """
+    Yield per time bin and tester slot over a production campaign.
+
+    Every run directory is reduced to the number of boards tested and
+    passed per tester_ID and test (plus the pseudo test "all": the board
+    passed every test of the run). The pass status of the boards is taken
+    from the retest history the merge builds (see RetestHistory), so no
+    test file is parsed for the trends. These per-directory counts are
+    persisted in counts_file together with the timestamp of the run and
+    the signature of its test files (mtime and size, as in ResultCache)
+    and of the cuts. update only reduces the directories that are new or
+    whose test files or cuts changed since the last update. The trends
+    (weekly, daily, ...) are summed from the counts when asked for.
+
+    Unlike the yield table, where a retested board only counts with its
+    newest run, every run counts here, a fixture that fails boards shows
+    up in the weeks it was used.
+    """
+
+    columns = ["run_dir", "signature", "timestamp", "tester_ID", "test", "tested", "passed"]
+
+    def __init__(self,
+                 counts_file: str | Path,
+                 tests: list[str]) -> None:
+        self.counts_file = Path(counts_file)
+        self.tests = tests
+        self.counts = pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in
+                                    zip(self.columns, ["string", "string", "datetime64[ns]", "int64",
+                                                       "string", "int64", "int64"])})
+        if self.counts_file.exists():
+            counts = pd.read_parquet(self.counts_file)
+            # counts written before the test files were signed are reduced again
+            if "signature" in counts.columns:
+                self.counts = counts
+        self.added = 0
+        self.updated = 0
+
+
+    def signature(self,
+                  tr) -> str:
+        # mtime and size of the test files, the tester to serial mapping of the run directory of tr and the cuts
+        signature = {"tester_to_serial": sorted(tr.tester_to_serial.items()),
+                     "cuts": tr.cut_table.fingerprint()}
+        for test in self.tests:
+            if tr.has_data(test):
+                stat = tr.get_datafile(test).stat()
+                signature[test] = [stat.st_mtime_ns, stat.st_size]
+        return json.dumps(signature)
+
+
+    def run_counts(self,
+                   runs: pd.DataFrame,
+                   testers: pd.DataFrame) -> pd.DataFrame:
+        """
+        Boards tested and passed per run_dir, tester_ID and test from runs,
+        rows of the retest history (see RetestHistory.history). testers maps
+        the run_dir and SN of a board to its tester_ID, boards without one
+        are left out. "all" covers the tests the run directory has results
+        for, a board missing one of them didn't pass them all.
+        """
+        runs = runs[runs["test"].isin(self.tests)].astype({"test": str, "run_dir": str})
+        runs = runs.merge(testers, on=["run_dir", "SN"])
+        counts = runs.groupby(["run_dir", "tester_ID", "test"], as_index=False).agg(
+            tested=("passed", "size"), passed=("passed", "sum"))
+        n_tests = runs.groupby("run_dir")["test"].nunique()
+        boards = runs.groupby(["run_dir", "SN"], as_index=False).agg(tester_ID=("tester_ID", "first"),
+                                                                     passed=("passed", "sum"))
+        boards["passed"] = boards["passed"].to_numpy() == boards["run_dir"].map(n_tests).to_numpy()
+        every = boards.groupby(["run_dir", "tester_ID"], as_index=False).agg(
+            tested=("passed", "size"), passed=("passed", "sum")).assign(test="all")
+        counts = pd.concat([counts, every], ignore_index=True)
+        return counts.astype({"tested": "int64", "passed": "int64"})
+
+
+    def update(self,
+               history: RetestHistory,
+               test_result_dirs: list[Path],
+               registry) -> pd.DataFrame:
+        """
+        Brings the counts up to date with test_result_dirs (the good run
+        directories, see RunDiscovery): new and changed directories are
+        reduced from the runs in history, the counts of directories that are
+        gone are dropped. registry is the TestResultRegistry the directories
+        are scanned with, for their test files and tester IDs.
+        """
+        known = self.counts.groupby("run_dir")["signature"].first().to_dict()
+        signatures = {}
+        testers = []
+        for d in test_result_dirs:
+            try:
+                tr = registry.get(d)
+            except FileNotFoundError:
+                continue
+            signatures[str(d)] = self.signature(tr)
+            if known.get(str(d)) == signatures[str(d)]:
+                continue
+            if str(d) in known:
+                self.updated += 1
+            else:
+                self.added += 1
+            testers.append(pd.DataFrame({"run_dir": str(d),
+                                         "SN": np.array(list(tr.tester_to_serial.values()), dtype=np.int64),
+                                         "tester_ID": np.array(list(tr.tester_to_serial), dtype=np.int64)}))
+        keep = self.counts["run_dir"].isin([d for d, signature in signatures.items() if known.get(d) == signature])
+        counts = [self.counts[keep]]
+        if len(testers) > 0:
+            testers = pd.concat(testers, ignore_index=True)
+            runs = history.history
+            runs = runs[runs["run_dir"].isin(testers["run_dir"].unique())]
+            run_counts = self.run_counts(runs, testers)
+            run_counts["signature"] = run_counts["run_dir"].map(signatures)
+            run_counts["timestamp"] = run_counts["run_dir"].map(RunDiscovery.run_time)
+            counts.append(run_counts)
+        self.counts = pd.concat(counts, ignore_index=True)[self.columns]
+        return self.counts
+
+
+    def save(self) -> None:
+        write_atomically(self.counts_file, lambda tmp_file: self.counts.to_parquet(tmp_file, index=False))
+
+
+    def trend(self,
+              freq: str = "W",
+              test: str = "all",
+              by_tester: bool = True,
+              window: int = 1) -> pd.DataFrame:
+        """
+        Boards tested and passed and the yield of the test per time bin
+        (a pandas period frequency, "W" for weeks) and, with by_tester, per
+        tester_ID. With window > 1 the counts are summed over that many bins
+        (per tester slot), smoothing the yield of bins with few boards.
+        """
+        counts = self.counts[self.counts["test"] == test]
+        time_bin = counts["timestamp"].dt.to_period(freq).dt.start_time.rename("time_bin")
+        keys = [time_bin, "tester_ID"] if by_tester else [time_bin]
+        trend = counts.groupby(keys)[["tested", "passed"]].sum()
+        if window > 1:
+            totals = trend.groupby(level="tester_ID") if by_tester else trend
+            trend = totals.rolling(window, min_periods=1).sum()
+            if by_tester:
+                trend = trend.droplevel(0).sort_index()
+            trend = trend.astype("int64")
+        trend["yield"] = trend["passed"] / trend["tested"]
+        return trend
+
+
+    def report(self) -> None:
+        print(f"Yield trends: reduced {self.added} new and {self.updated} changed run directories, "
+              f"{self.counts['run_dir'].nunique()} in total")
+
+
+if __name__ == "__main__":
+    import argparse
+    from get_tables import TestResultRegistry, test_map
+    parser = argparse.ArgumentParser(description="Yield per time bin and tester slot over a campaign")
+    parser.add_argument("--base_dir",
+                        type=str,
+                        required=True,
+                        help="Directory containing the run directories")
+    parser.add_argument("--counts_file",
+                        type=str,
+                        default="output/trends.parquet",
+                        help="Per-directory counts, updated with the new and changed directories")
+    parser.add_argument("--history",
+                        type=str,
+                        default="output/history.parquet",
+                        help="Retest history written by get_tables.py, the pass status of the boards is taken from it")
+    parser.add_argument("--freq",
+                        type=str,
+                        default="W",
+                        help="Time bin of the trend (pandas period frequency, e.g. W or D)")
+    parser.add_argument("--test",
+                        type=str,
+                        default="all",
+                        help="Test to show the trend of (default: all tests passed)")
+    parser.add_argument("--window",
+                        type=int,
+                        default=1,
+                        help="Number of time bins the counts are summed over")
+    args = parser.parse_args()
+    trends = YieldTrends(args.counts_file, [test for test in test_map if "TestPulse" not in test])
+    discovery = RunDiscovery(args.base_dir)
+    test_result_dirs = discovery.discover()
+    trends.update(RetestHistory.load(args.history), test_result_dirs, TestResultRegistry(discovery=discovery))
+    trends.save()
+    trends.report()
+    print(trends.trend(args.freq, args.test, window=args.window).to_string(float_format="{:.3f}".format))
@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+
+
+def pass_column_test(column: str) -> str:
+    # test of a yield table column, <test>_pass (get_tables.py) or <test>_test_pass
+    return column.removesuffix("_pass").removesuffix("_test")
+
+
+class YieldMatrix:
+    """
+    Pass/fail/missing of every board in every test, stored as two uint32
+    bitmasks per SN: bit i of `present` is set if the board has a result for
+    tests[i], bit i of `passed` if it passed it. A board without a result for
+    a test neither passes nor fails it.
+
+    All questions about the yield are answered with vectorized bit operations
+    on the two arrays (8 bytes per board, whatever the number of tests), so
+    the matrix of millions of boards is cheap to keep around and to query.
+    """
+
+    max_tests = 32
+
+    def __init__(self,
+                 sns: np.ndarray,
+                 tests: list[str],
+                 present: np.ndarray,
+                 passed: np.ndarray) -> None:
+        if len(tests) > self.max_tests:
+            raise ValueError(f"At most {self.max_tests} tests fit in the bitmask, got {len(tests)}")
+        self.sns = np.asarray(sns)
+        self.tests = list(tests)
+        self.present = np.asarray(present, dtype=np.uint32)
+        # a board can only pass a test it has a result for
+        self.passed = np.asarray(passed, dtype=np.uint32) & self.present
+        self.all_tests = np.uint32((1 << len(self.tests)) - 1)
+
+
+    @classmethod
+    def from_series(cls,
+                    results: dict[str, pd.Series]) -> "YieldMatrix":
+        """
+        Builds the matrix from one Series SN -> pass per test (unique SNs,
+        missing values count as no result)
+        """
+        results = {test: result.dropna() for test, result in results.items()}
+        sns = np.unique(np.concatenate([result.index.to_numpy(dtype=np.int64) for result in results.values()]
+                                       or [np.empty(0, dtype=np.int64)]))
+        present = np.zeros(len(sns), dtype=np.uint32)
+        passed = np.zeros(len(sns), dtype=np.uint32)
+        for i, result in enumerate(results.values()):
+            bit = np.uint32(1 << i)
+            rows = np.searchsorted(sns, result.index.to_numpy(dtype=np.int64))
+            present[rows] |= bit
+            passed[rows[result.to_numpy(dtype=bool)]] |= bit
+        return cls(sns, list(results), present, passed)
+
+
+    @classmethod
+    def from_frame(cls,
+                   yield_df: pd.DataFrame) -> "YieldMatrix":
+        # from a yield table indexed by SN with one <test>_pass (or <test>_test_pass) column per test
+        columns = [col for col in yield_df.columns if col.endswith("_pass")]
+        return cls.from_series({pass_column_test(col): yield_df[col] for col in columns})
+
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        The yield table indexed by SN with one <test>_pass column per test,
+        NaN where a board has no result for the test
+        """
+        columns = {}
+        for i, test in enumerate(self.tests):
+            passed = pd.Series((self.passed >> np.uint32(i)) & 1 == 1, index=pd.Index(self.sns, name="SN"))
+            columns[f"{test}_pass"] = passed.where((self.present >> np.uint32(i)) & 1 == 1)
+        return pd.DataFrame(columns, index=pd.Index(self.sns, name="SN"))
+
+
+    def mask(self,
+             tests: list[str]) -> np.uint32:
+        # bits of the given tests
+        mask = 0
+        for test in tests:
+            if test not in self.tests:
+                raise ValueError(f"Test {test} not in {self.tests}")
+            mask |= 1 << self.tests.index(test)
+        return np.uint32(mask)
+
+
+    @property
+    def failed(self) -> np.ndarray:
+        return self.present & ~self.passed
+
+
+    def passes_all(self) -> np.ndarray:
+        # boards with a passing result in every test
+        return self.passed == self.all_tests
+
+
+    def overall_yield(self) -> float:
+        return float(self.passes_all().mean()) if len(self.sns) > 0 else 0.0
+
+
+    def test_counts(self) -> pd.DataFrame:
+        # number of boards passing, failing and missing every test
+        counts = {}
+        for i, test in enumerate(self.tests):
+            bit = np.uint32(1 << i)
+            n_present = int(np.count_nonzero(self.present & bit))
+            n_passed = int(np.count_nonzero(self.passed & bit))
+            counts[test] = {"passed": n_passed,
+                            "failed": n_present - n_passed,
+                            "missing": len(self.sns) - n_present}
+        return pd.DataFrame.from_dict(counts, orient="index")
+
+
+    def test_yields(self) -> pd.Series:
+        # fraction of all boards passing each test
+        return self.test_counts()["passed"] / max(len(self.sns), 1)
+
+
+    def failing_any(self,
+                    tests: list[str]) -> np.ndarray:
+        # boards failing at least one of the tests
+        return (self.failed & self.mask(tests)) != 0
+
+
+    def fails_only(self,
+                   test: str) -> np.ndarray:
+        # boards failing the test and no other one (the other tests are passed or missing)
+        return self.failed == self.mask([test])
+
+
+    def failure_combinations(self,
+                             min_boards: int = 1) -> pd.DataFrame:
+        """
+        Number of boards per combination of failed tests (an UpSet plot
+        breakdown), the most frequent combinations first. Boards failing no
+        test are not counted.
+        """
+        failed = self.failed
+        masks, counts = np.unique(failed[failed != 0], return_counts=True)
+        keep = counts >= min_boards
+        masks, counts = masks[keep], counts[keep]
+        combinations = pd.DataFrame({"tests": [", ".join(test for i, test in enumerate(self.tests) if mask >> i & 1)
+                                               for mask in masks],
+                                     "n_tests": [int(mask).bit_count() for mask in masks],
+                                     "boards": counts})
+        return combinations.sort_values(["boards", "n_tests"], ascending=[False, True],
+                                        kind="stable").reset_index(drop=True)
+
+
+    def summary(self) -> None:
+        print(f"Overall yield: {self.overall_yield():.2%} of {len(self.sns)} boards")
+        print(self.failure_combinations().head(10).to_string(index=False))